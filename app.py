@@ -1,52 +1,507 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, abort, g, has_request_context, session
+from flask import before_render_template, stream_with_context, template_rendered
+from werkzeug.exceptions import HTTPException, NotFound
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_migrate import Migrate
+from markupsafe import Markup
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import make_transient_to_detached
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import safe_join, secure_filename
 from PIL import Image
+try:
+    import redis
+except ImportError:  # only needed when CACHE_BACKEND is 'redis'
+    redis = None
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:  # rebuild-recommendations falls back to scoring one user at a time
+    numpy = sparse = None
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+from functools import cached_property, partial, wraps
+from itertools import islice
+from threading import Event, Lock, Thread
+import time
+import base64
+import click
+import csv
+import glob
+import hashlib
+import json
+import math
+import mimetypes
 import re
+import sqlite3
+import tempfile
 import os
-from datetime import datetime
+import random
+import subprocess
+from datetime import datetime, timedelta
+from urllib.parse import quote
 
 app = Flask(__name__, static_url_path='/static')
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///users.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join('static', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
-
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024
+app.config['UPLOAD_MAX_AGE'] = 365 * 24 * 3600  # content-addressed files never change
+app.config['MEDIA_OFFLOAD'] = None  # None (send from the app), 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd)
+app.config['MEDIA_ACCEL_PREFIX'] = '/protected-media/'  # nginx internal location aliased to UPLOAD_FOLDER
+app.config['PAGE_SIZE'] = 20  # posts, comments and users per page
+app.config['API_BATCH_LIMIT'] = 100  # ids or actions per JSON API call
+app.config['BULK_CHUNK_SIZE'] = 1000  # records per insert/commit in import-data, rows per fetch in exports
+app.config['FEED_BACKFILL_SIZE'] = 100  # posts copied into a timeline on follow/join
+app.config['FEED_FANOUT_LIMIT'] = 5000  # authors above this many followers are merged on read
+app.config['RECOMMENDATIONS_TOP_K'] = 20  # suggestions stored per user and kind
+app.config['RECOMMENDATIONS_SHOWN'] = 5
+app.config['RECOMMENDATION_GROUP_SIZE_LIMIT'] = 1000  # larger groups don't count as a shared group
+app.config['RECOMMENDATION_BATCH_SIZE'] = 1000  # users scored per sparse matrix product
+app.config['RANKING_HALF_LIFE'] = 12 * 3600  # seconds for a post's hotness to halve
+app.config['RANKING_LIKE_WEIGHT'] = 1.0
+app.config['RANKING_COMMENT_WEIGHT'] = 2.0
+app.config['RANKING_SHOWN'] = 20  # trending posts and active groups listed
+app.config['RANKING_CANDIDATES'] = 500  # hottest posts cached per list, before filtering by viewer
+app.config['RANKING_CACHE_TTL'] = 60  # seconds a cached trending list may lag behind the scores
+# 'fts5' (SQLite full-text index) or 'like' (substring scan); defaults to fts5 on SQLite only
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND') or (
+    'fts5' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') else 'like')
+app.config['IMAGE_WORKERS'] = 2  # processes rendering uploaded images
+app.config['IMAGE_RENDITIONS'] = {  # upload folder -> rendition name -> (width, height)
+    'posts': {'thumb': (320, 180), 'feed': (800, 450), 'full': (1600, 900)},
+    'profile_pics': {'thumb': (160, 90), 'full': (320, 180)},
+}
+app.config['CACHE_BACKEND'] = 'local'  # 'local' (per process) or 'redis' (shared)
+app.config['CACHE_REDIS_URL'] = 'redis://localhost:6379/0'
+app.config['USER_CACHE_SIZE'] = 10000
+app.config['USER_CACHE_TTL'] = 60  # seconds
+app.config['FRAGMENT_CACHE_SIZE'] = 5000  # rendered post cards
+app.config['FRAGMENT_CACHE_TTL'] = 600  # seconds
+app.config['LIKE_WRITE_BEHIND'] = False  # buffer like/unlike writes and apply them in batches
+app.config['LIKE_FLUSH_INTERVAL'] = 0.5  # seconds between batched like writes
+app.config['LIKE_BUFFER_SIZE'] = 1000  # pending like events that trigger an early flush
+app.config['LIVE_UPDATES_BROKER'] = 'local'  # 'local' (this process) or 'redis' (CACHE_REDIS_URL, all workers)
+app.config['LIVE_UPDATE_INTERVAL'] = 1.0  # seconds a stream waits after sending, so bursts arrive as one update
+app.config['LIVE_KEEPALIVE'] = 15  # seconds between keepalive comments on an idle stream
+app.config['LIVE_STREAM_DURATION'] = 300  # seconds before a stream ends and the browser reconnects
+app.config['LIVE_MAX_STREAMS'] = 1000  # open streams per process; each holds a worker thread
+app.config['LIVE_TRACKED_POSTS'] = 10000  # posts whose latest counts are kept for streams
+app.config['LIVE_COMMENT_BACKLOG'] = 20  # recent comments kept per post for streams that fell behind
+app.config['BACKGROUND_WORKERS'] = 4
+app.config['BACKGROUND_TASKS_SYNC'] = False  # run background tasks inline (tests, debugging)
+app.config['INSTRUMENTATION'] = True  # per-request SQL/render timing, Server-Timing header, /metrics
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'  # werkzeug method string; older hashes upgrade on signin
+app.config['PASSWORD_SALT_LENGTH'] = 16
+app.config['PASSWORD_HASH_WORKERS'] = 2  # threads hashing passwords; the rest of the CPU stays with requests
+app.config['PASSWORD_HASH_QUEUE_LIMIT'] = 32  # pending hashes before signin/signup answer 503
+app.config['SIGNIN_THROTTLE_WINDOW'] = 300  # seconds failed sign-ins are remembered
+app.config['SIGNIN_MAX_FAILURES_PER_ACCOUNT'] = 5
+app.config['SIGNIN_MAX_FAILURES_PER_IP'] = 20
+app.config['REPEATED_STATEMENT_THRESHOLD'] = 5  # identical statements in one request flagged as N+1
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # bearer token required by /metrics if set
+
+# Storage
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',  # readers no longer block the writer
+    'synchronous': 'NORMAL',  # safe with WAL, far fewer fsyncs
+    'busy_timeout': 5000,  # ms to wait for a lock instead of failing with "database is locked"
+    'cache_size': -20000,  # 20MB page cache per connection
+    'temp_store': 'MEMORY',
+}
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+app.config['DATABASE_POOL_RECYCLE'] = 1800  # seconds; server databases drop idle connections
+# Read replicas, comma-separated URLs; views marked @read_replica read from them
+app.config['DATABASE_REPLICA_URLS'] = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['READ_REPLICA_STICKY_SECONDS'] = 10  # reads stay on the primary this long after a client writes
+app.config['READ_REPLICA_RETRY'] = 30  # seconds a failed replica is skipped before it is tried again
+
+def storage_engine_options(config, uri=None):
+    """SQLAlchemy engine options for the configured database URI, or for uri."""
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    options = {'connect_args': {}}
+    if url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):
+        # In-memory SQLite gets a single shared connection (StaticPool), which takes no pool sizes
+        options.update(pool_size=config['DATABASE_POOL_SIZE'], max_overflow=config['DATABASE_MAX_OVERFLOW'])
+    if url.get_backend_name() == 'sqlite':
+        # Pooled connections are shared between request and background threads
+        options['connect_args'] = {'check_same_thread': False,
+                                   'timeout': config['SQLITE_PRAGMAS']['busy_timeout'] / 1000}
+    else:
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = config['DATABASE_POOL_RECYCLE']
+    return options
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage_engine_options(app.config)
+app.config['SQLALCHEMY_BINDS'] = {f'replica{i}': {'url': url, **storage_engine_options(app.config, url)}
+                                  for i, url in enumerate(app.config['DATABASE_REPLICA_URLS'])}
+
+class RoutingSession(Session):
+    """Sends SELECTs inside @read_replica views to g.read_replica; everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or not getattr(clause, 'is_select', False):
+                g.wrote_to_primary = True
+            elif g.get('read_replica') is not None:
+                return g.read_replica
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+@db.event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for name, value in app.config['SQLITE_PRAGMAS'].items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+def include_in_migrations(name, type_, parent_names):
+    # FTS5 virtual tables and their shadow tables are managed by FTS5SearchBackend
+    # import_ scratch tables only exist while import-data runs
+    return not (type_ == 'table' and name.startswith(('search_', 'import_')))
+
+migrate = Migrate(app, db, include_name=include_in_migrations)
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'signin'
 
+# Read replicas
+class ReadReplicas:
+    """The replica binds, handed out in turn; one that fails is skipped for READ_REPLICA_RETRY seconds."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._down_until = {}
+        self._turn = 0
+        self._lock = Lock()
+
+    def choose(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [key for key in self.keys if self._down_until.get(key, 0) <= now]
+            if not healthy:
+                return None
+            self._turn += 1
+            return healthy[self._turn % len(healthy)]
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down_until[key] = time.monotonic() + app.config['READ_REPLICA_RETRY']
+        app.logger.warning('Read replica %s failed; using the primary for %ss',
+                           key, app.config['READ_REPLICA_RETRY'])
+
+read_replicas = ReadReplicas(list(app.config['SQLALCHEMY_BINDS']))
+
+@db.event.listens_for(Engine, 'handle_error')
+def note_replica_error(context):
+    if has_request_context() and g.get('read_replica') is not None and context.engine is g.read_replica:
+        g.read_replica_failed = True
+
+def read_replica(view):
+    """Run a read-only view against a healthy replica.
+
+    Clients that wrote in the last READ_REPLICA_STICKY_SECONDS read from the primary, so they
+    see their own changes. If the replica fails, it is marked down and the view runs again on
+    the primary; so does a 404, which may only mean the replica is behind.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = None
+        if session.get('read_primary_until', 0) <= time.time():
+            key = read_replicas.choose()
+        if key is None:
+            return view(*args, **kwargs)
+        g.read_replica = db.engines[key]
+        try:
+            return view(*args, **kwargs)
+        except NotFound:
+            # Possibly a row the replica hasn't caught up with yet
+            pass
+        except DBAPIError:
+            if not g.pop('read_replica_failed', False):
+                raise
+            read_replicas.mark_down(key)
+        db.session.rollback()
+        g.read_replica = None
+        # Drop what the first attempt cached from the replica
+        g.pop('relationships', None)
+        g.pop('page_validators', None)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.after_request
+def stick_to_primary(response):
+    if g.pop('wrote_to_primary', False) and read_replicas.keys:
+        session['read_primary_until'] = time.time() + app.config['READ_REPLICA_STICKY_SECONDS']
+    return response
+
+background_executor = ThreadPoolExecutor(max_workers=app.config['BACKGROUND_WORKERS'],
+                                         thread_name_prefix='synapse-bg')
+image_pool = ProcessPoolExecutor(max_workers=app.config['IMAGE_WORKERS'])
+
+# Instrumentation
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class RequestStats:
+    """What the current request has spent so far, kept in g.request_stats."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = Counter()  # SQL text -> executions
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.image_time = 0.0
+        self.render_started = None
+
+def request_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+class RouteMetrics:
+    """Per-process totals by endpoint, exposed in the Prometheus text format."""
+
+    def __init__(self):
+        self._routes = {}  # endpoint -> totals
+        self._images = {}  # upload folder -> [renders, seconds]
+        self._lock = Lock()
+
+    def record_request(self, endpoint, stats, duration, repeated):
+        with self._lock:
+            route = self._routes.get(endpoint)
+            if route is None:
+                route = self._routes[endpoint] = {
+                    'buckets': [0] * len(REQUEST_DURATION_BUCKETS), 'count': 0, 'seconds': 0.0,
+                    'statements': 0, 'db_seconds': 0.0, 'render_seconds': 0.0,
+                    'image_seconds': 0.0, 'repeated_statements': 0}
+            for i, bound in enumerate(REQUEST_DURATION_BUCKETS):
+                if duration <= bound:
+                    route['buckets'][i] += 1
+            route['count'] += 1
+            route['seconds'] += duration
+            route['statements'] += sum(stats.statements.values())
+            route['db_seconds'] += stats.db_time
+            route['render_seconds'] += stats.render_time
+            route['image_seconds'] += stats.image_time
+            route['repeated_statements'] += repeated
+
+    def record_image(self, folder, seconds):
+        with self._lock:
+            totals = self._images.setdefault(folder, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def render(self):
+        with self._lock:
+            routes = {endpoint: dict(route, buckets=list(route['buckets']))
+                      for endpoint, route in self._routes.items()}
+            images = {folder: list(totals) for folder, totals in self._images.items()}
+
+        lines = ['# TYPE synapse_request_duration_seconds histogram']
+        for endpoint, route in routes.items():
+            for bound, count in zip(REQUEST_DURATION_BUCKETS, route['buckets']):
+                lines.append(f'synapse_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'synapse_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {route["count"]}')
+            lines.append(f'synapse_request_duration_seconds_sum{{endpoint="{endpoint}"}} {route["seconds"]}')
+            lines.append(f'synapse_request_duration_seconds_count{{endpoint="{endpoint}"}} {route["count"]}')
+        for name, key in (('db_statements_total', 'statements'), ('db_seconds_total', 'db_seconds'),
+                          ('render_seconds_total', 'render_seconds'), ('image_seconds_total', 'image_seconds'),
+                          ('repeated_statements_total', 'repeated_statements')):
+            lines.append(f'# TYPE synapse_{name} counter')
+            lines.extend(f'synapse_{name}{{endpoint="{endpoint}"}} {route[key]}'
+                         for endpoint, route in routes.items())
+        lines.append('# TYPE synapse_image_processing_seconds summary')
+        for folder, (count, seconds) in images.items():
+            lines.append(f'synapse_image_processing_seconds_sum{{folder="{folder}"}} {seconds}')
+            lines.append(f'synapse_image_processing_seconds_count{{folder="{folder}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+route_metrics = RouteMetrics()
+
+@app.before_request
+def start_request_stats():
+    if app.config['INSTRUMENTATION']:
+        g.request_stats = RequestStats()
+
+@app.after_request
+def record_request_stats(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    duration = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+
+    repeated = 0
+    for statement, executions in stats.statements.items():
+        if executions >= app.config['REPEATED_STATEMENT_THRESHOLD']:
+            repeated += 1
+            app.logger.warning('Possible N+1 in %s: statement ran %d times: %s',
+                               endpoint, executions, statement)
+    route_metrics.record_request(endpoint, stats, duration, repeated)
+
+    response.headers.add('Server-Timing', ', '.join([
+        f'db;dur={stats.db_time * 1000:.1f};desc="{sum(stats.statements.values())} statements"',
+        f'render;dur={stats.render_time * 1000:.1f}',
+        f'image;dur={stats.image_time * 1000:.1f}',
+        f'total;dur={duration * 1000:.1f}',
+    ]))
+    return response
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    if request_stats() is not None:
+        conn.info['statement_started'] = time.perf_counter()
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('statement_started', None)
+    stats = request_stats()
+    if stats is not None and started is not None:
+        stats.db_time += time.perf_counter() - started
+        stats.statements[statement] += 1
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    stats = request_stats()
+    if stats is not None:
+        stats.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_render(sender, template, context, **extra):
+    stats = request_stats()
+    if stats is not None and stats.render_started is not None:
+        stats.render_time += time.perf_counter() - stats.render_started
+        stats.render_started = None
+
+# Caching
+class LocalCache:
+    """Thread-safe in-process LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class RedisCache:
+    """Cache shared between processes through Redis; values are stored as JSON."""
+
+    def __init__(self, url, prefix, ttl):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND 'redis' requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+def make_cache(name, maxsize, ttl):
+    if app.config['CACHE_BACKEND'] == 'redis':
+        return RedisCache(app.config['CACHE_REDIS_URL'], f'synapse:{name}:', ttl)
+    return LocalCache(maxsize, ttl)
+
+user_cache = make_cache('user', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+fragment_cache = make_cache('fragment', app.config['FRAGMENT_CACHE_SIZE'],
+                            app.config['FRAGMENT_CACHE_TTL'])
+
 # directories
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'profile_pics'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'posts'), exist_ok=True)
 
 # Tables
+# Association tables are keyed in one direction and indexed in the other, with
+# (owner, timestamp) indexes for the paginated lists
 followers_association = db.Table('followers_association',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow)
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_followers_association_followed', 'followed_id', 'follower_id'),
+    db.Index('ix_followers_association_follower_timestamp', 'follower_id', 'timestamp'),
+    db.Index('ix_followers_association_followed_timestamp', 'followed_id', 'timestamp')
 )
 
 follow_requests = db.Table('follow_requests',
-    db.Column('requester_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('requested_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow)
+    db.Column('requester_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('requested_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_follow_requests_requested', 'requested_id', 'requester_id'),
+    db.Index('ix_follow_requests_requested_timestamp', 'requested_id', 'timestamp')
 )
 
 # Table for group members
 group_members = db.Table('group_members',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('group_id', db.Integer, db.ForeignKey('group.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow)
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('group_id', db.Integer, db.ForeignKey('group.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_group_members_group', 'group_id', 'user_id'),
+    db.Index('ix_group_members_group_timestamp', 'group_id', 'timestamp')
 )
 
 
+class Relationships:
+    """A user's follow, follow-request and group-membership id sets, each loaded with one query."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def _ids(self, column, owner_column):
+        return set(db.session.scalars(db.select(column).where(owner_column == self.user_id)))
+
+    @cached_property
+    def following_ids(self):
+        return self._ids(followers_association.c.followed_id, followers_association.c.follower_id)
+
+    @cached_property
+    def sent_request_ids(self):
+        return self._ids(follow_requests.c.requested_id, follow_requests.c.requester_id)
+
+    @cached_property
+    def received_request_ids(self):
+        return self._ids(follow_requests.c.requester_id, follow_requests.c.requested_id)
+
+    @cached_property
+    def group_ids(self):
+        return self._ids(group_members.c.group_id, group_members.c.user_id)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
@@ -54,6 +509,10 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(255), nullable=False)
     bio = db.Column(db.Text)
     profile_pic = db.Column(db.String(255))
+    profile_pic_renditions = db.Column(db.JSON)  # rendition name -> file stem
+    # Denormalized counters, kept in step by the follow/unfollow methods
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
     # Relationship for followers
@@ -77,35 +536,77 @@ class User(UserMixin, db.Model):
     groups = db.relationship('Group', secondary=group_members, backref=db.backref('members', lazy='dynamic'))
 
     # User methods
+    @property
+    def relationships(self):
+        # Cached for the rest of the request so repeated checks are set lookups
+        if not has_request_context():
+            return Relationships(self.id)
+        cache = g.setdefault('relationships', {})
+        if self.id not in cache:
+            cache[self.id] = Relationships(self.id)
+        return cache[self.id]
+
+    def reset_relationships(self, *users):
+        if has_request_context():
+            cache = g.get('relationships', {})
+            for user in (self,) + users:
+                cache.pop(user.id, None)
+
     def follow(self, user):
         if not self.is_following(user):
             self.following.append(user)
+            self._adjust_follow_counts(follower=self, followed=user, delta=1)
+            self.reset_relationships(user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self._adjust_follow_counts(follower=self, followed=user, delta=-1)
+            self.reset_relationships(user)
+
+    @staticmethod
+    def _adjust_follow_counts(follower, followed, delta):
+        # SQL-side increments so concurrent transactions don't lose updates
+        follower.following_count = User.following_count + delta
+        followed.followers_count = User.followers_count + delta
 
     def is_following(self, user):
-        return self.following.filter(followers_association.c.followed_id == user.id).count() > 0
+        return user.id in self.relationships.following_ids
 
     def send_follow_request(self, user):
         if not self.has_sent_request(user):
             self.sent_requests.append(user)
+            self.reset_relationships(user)
 
     def has_sent_request(self, user):
-        return self.sent_requests.filter(follow_requests.c.requested_id == user.id).count() > 0
+        return user.id in self.relationships.sent_request_ids
 
     def accept_follow_request(self, user):
         if self.has_received_request(user):
             self.follow_requests.remove(user)
             self.followers.append(user)
+            self._adjust_follow_counts(follower=user, followed=self, delta=1)
+            self.reset_relationships(user)
 
     def decline_follow_request(self, user):
         if self.has_received_request(user):
             self.follow_requests.remove(user)
+            self.reset_relationships(user)
 
     def has_received_request(self, user):
-        return self.follow_requests.filter(follow_requests.c.requester_id == user.id).count() > 0
+        return user.id in self.relationships.received_request_ids
+
+    def is_member(self, group):
+        return group.id in self.relationships.group_ids
+
+    def liked_post_ids(self, posts):
+        # One query for the whole page instead of a `self in post.likes` per post
+        post_ids = [post.id for post in posts]
+        if not post_ids:
+            return set()
+        return set(db.session.scalars(
+            db.select(post_likes.c.post_id)
+            .where(post_likes.c.user_id == self.id, post_likes.c.post_id.in_(post_ids))))
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -114,15 +615,45 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     image = db.Column(db.String(255))
     video = db.Column(db.String(255))
+    image_status = db.Column(db.String(20))  # 'processing', 'ready' or 'failed'
+    image_renditions = db.Column(db.JSON)  # rendition name -> file stem
     likes = db.relationship('User', secondary='post_likes', backref=db.backref('liked_posts', lazy='dynamic'))
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
+    # Denormalized counters, kept in step by like_post/unlike_post/add_comment
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comments_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    hotness = db.Column(db.Float)  # see post_hotness; set by update_rankings
+
+    __table_args__ = (
+        db.Index('ix_post_hotness', 'hotness'),
+        db.Index('ix_post_group_hotness', 'group_id', 'hotness'),
+        # Keyset pages of a group's posts and of one author's personal posts (group_id IS NULL)
+        db.Index('ix_post_group_timestamp', 'group_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_group_timestamp', 'user_id', 'group_id', 'timestamp', 'id'),
+    )
+
+    @staticmethod
+    def visible_to(user):
+        # Personal posts of the user and the people they follow, plus posts in their groups
+        followed_ids = (db.select(followers_association.c.followed_id)
+                        .where(followers_association.c.follower_id == user.id))
+        group_ids = db.select(group_members.c.group_id).where(group_members.c.user_id == user.id)
+        return db.or_(
+            db.and_(Post.group_id == None,
+                    db.or_(Post.user_id == user.id, Post.user_id.in_(followed_ids))),
+            Post.group_id.in_(group_ids))
+
+    @property
+    def cache_version(self):
+        # Changes whenever a like, unlike, comment or finished image alters the rendered card
+        return f'{self.likes_count}.{self.comments_count}.{self.image_status}'
 
     def like_count(self):
-        return len(self.likes)
+        return self.likes_count
 
     def comment_count(self):
-        return self.comments.count()
+        return self.comments_count
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -132,23 +663,83 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('comments', lazy='dynamic')) # loads relation lazily
 
+    __table_args__ = (
+        # Keyset pages of one post's comments
+        db.Index('ix_comment_post_timestamp', 'post_id', 'timestamp', 'id'),
+    )
+
 post_likes = db.Table('post_likes',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Index('ix_post_likes_post', 'post_id', 'user_id')
 ) 
 
+# Materialized home timeline: one row per (reader, post), filled by fan_out_post
+feed_entries = db.Table('feed_entries',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_feed_entries_user_timestamp', 'user_id', 'timestamp', 'post_id')
+)
+
+# Precomputed suggestions: the top RECOMMENDATIONS_TOP_K people and groups per user
+recommendations = db.Table('recommendations',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('kind', db.String(10), primary_key=True),  # 'user' or 'group'
+    db.Column('target_id', db.Integer, primary_key=True),
+    db.Column('score', db.Float, nullable=False),
+    db.Index('ix_recommendations_user_kind_score', 'user_id', 'kind', 'score')
+)
+
+# Content-addressed uploads: one row per distinct file, counting the rows that use it
+class StoredFile(db.Model):
+    key = db.Column(db.String(255), primary_key=True)  # '<folder>/<ab>/<cd>/<sha256>'
+    filename = db.Column(db.String(255), nullable=False)  # original, relative to the folder
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     description = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    activity = db.Column(db.Float, index=True)  # log-sum of its posts' hotness
     creator = db.relationship('User', backref=db.backref('created_groups', lazy='dynamic'))
     posts = db.relationship('Post', backref='group', lazy='dynamic')
 
+# Column values cached by load_user; the password hash is left out and loaded on access
+USER_CACHE_COLUMNS = [column.key for column in User.__table__.columns if column.key != 'password']
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        user = User(**cached)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = User.query.get(int(user_id))
+    if user is not None:
+        user_cache.set(user_id, {key: getattr(user, key) for key in USER_CACHE_COLUMNS})
+    return user
+
+@db.event.listens_for(db.session, 'before_flush')
+def collect_changed_users(session, flush_context, instances):
+    changed = session.info.setdefault('changed_user_ids', set())
+    changed.update(str(obj.id) for obj in session.dirty | session.deleted
+                   if isinstance(obj, User) and (obj in session.deleted or session.is_modified(
+                       obj, include_collections=False)))
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        user_cache.delete(user_id)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
 
 # Validation for pw
 def validate_password(password):
@@ -159,41 +750,1371 @@ def validate_password(password):
         return True
     return False
 
+# Password hashing
+class PasswordHasher:
+    """Hashes and checks passwords on a small bounded pool.
+
+    A login storm then occupies at most PASSWORD_HASH_WORKERS cores, and callers beyond
+    PASSWORD_HASH_QUEUE_LIMIT pending hashes get a 503 instead of queueing behind them.
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='synapse-hash')
+        self._pending = 0
+        self._lock = Lock()
+        self.stats = {'hashed': 0, 'verified': 0, 'rejected': 0, 'seconds': 0.0}
+
+    def _run(self, kind, func, *args):
+        with self._lock:
+            if self._pending >= app.config['PASSWORD_HASH_QUEUE_LIMIT']:
+                self.stats['rejected'] += 1
+                abort(503, 'Too many sign-ins in progress, please try again shortly.')
+            self._pending += 1
+        try:
+            return self._executor.submit(self._timed, kind, func, *args).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _timed(self, kind, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.stats[kind] += 1
+                self.stats['seconds'] += time.perf_counter() - started
+
+    def hash(self, password):
+        return self._run('hashed', generate_password_hash, password,
+                         app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
+    def hash_many(self, passwords):
+        # Bulk imports: every worker at once, outside the request queue limit
+        return self._executor.map(lambda password: self._timed(
+            'hashed', generate_password_hash, password,
+            app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH']), passwords)
+
+    def verify(self, stored_hash, password):
+        return self._run('verified', check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        return stored_hash.split('$', 1)[0] != app.config['PASSWORD_HASH_METHOD']
+
+    def render_metrics(self):
+        with self._lock:
+            stats, pending = dict(self.stats), self._pending
+        return (f'# TYPE synapse_password_hash_pending gauge\n'
+                f'synapse_password_hash_pending {pending}\n'
+                f'# TYPE synapse_password_hash_total counter\n'
+                f'synapse_password_hash_total{{kind="hash"}} {stats["hashed"]}\n'
+                f'synapse_password_hash_total{{kind="verify"}} {stats["verified"]}\n'
+                f'synapse_password_hash_rejected_total {stats["rejected"]}\n'
+                f'synapse_password_hash_seconds_total {stats["seconds"]}\n')
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'])
+
+def upgrade_password_hash(user_id, password):
+    # Re-hash with the current PASSWORD_HASH_METHOD; runs after a successful signin
+    user = db.session.get(User, user_id)
+    if user is not None and password_hasher.needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+
+class SigninThrottle:
+    """Failed sign-ins per account and per client address, counted in a cache.
+
+    Once either is over its limit, attempts are refused before the user lookup and the hash.
+    """
+
+    def __init__(self):
+        self._failures = make_cache('signin', 100000, app.config['SIGNIN_THROTTLE_WINDOW'])
+
+    def _limits(self, username, address):
+        return [(f'user:{username.lower()}', app.config['SIGNIN_MAX_FAILURES_PER_ACCOUNT']),
+                (f'ip:{address}', app.config['SIGNIN_MAX_FAILURES_PER_IP'])]
+
+    def blocked(self, username, address):
+        return any((self._failures.get(key) or 0) >= limit for key, limit in self._limits(username, address))
+
+    def failed(self, username, address):
+        for key, _ in self._limits(username, address):
+            self._failures.set(key, (self._failures.get(key) or 0) + 1)
+
+    def succeeded(self, username):
+        self._failures.delete(f'user:{username.lower()}')
+
+signin_throttle = SigninThrottle()
+
 # Image resizing
-def resize_and_crop(image_path, size, aspect_ratio='square'):
-    with Image.open(image_path) as img:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+def crop_to_aspect(img, aspect_ratio):
+    if aspect_ratio == 'square':
+        
+        width, height = img.size
+        new_size = min(width, height)
+        
+        left = (width - new_size) / 2
+        top = (height - new_size) / 2
+        right = (width + new_size) / 2
+        bottom = (height + new_size) / 2
+        
+        img = img.crop((left, top, right, bottom))
+    elif aspect_ratio == '16:9':
         
-        if aspect_ratio == 'square':
-            
-            width, height = img.size
-            new_size = min(width, height)
-            
-            left = (width - new_size) / 2
-            top = (height - new_size) / 2
-            right = (width + new_size) / 2
-            bottom = (height + new_size) / 2
-            
-            img = img.crop((left, top, right, bottom))
-        elif aspect_ratio == '16:9':
-            
-            aspect_ratio_original = img.width / img.height
-            aspect_ratio_target = 16 / 9
-            
-            if aspect_ratio_original > aspect_ratio_target:
-                # Original image is wider, crop the width
-                new_width = int(img.height * aspect_ratio_target)
-                left = (img.width - new_width) // 2
-                img = img.crop((left, 0, left + new_width, img.height))
-            elif aspect_ratio_original < aspect_ratio_target:
-                # Original image is taller, crop the height
-                new_height = int(img.width / aspect_ratio_target)
-                top = (img.height - new_height) // 2
-                img = img.crop((0, top, img.width, top + new_height))
+        aspect_ratio_original = img.width / img.height
+        aspect_ratio_target = 16 / 9
         
-        img = img.resize(size, Image.LANCZOS)
-        img.save(image_path)
+        if aspect_ratio_original > aspect_ratio_target:
+            # Original image is wider, crop the width
+            new_width = int(img.height * aspect_ratio_target)
+            left = (img.width - new_width) // 2
+            img = img.crop((left, 0, left + new_width, img.height))
+        elif aspect_ratio_original < aspect_ratio_target:
+            # Original image is taller, crop the height
+            new_height = int(img.width / aspect_ratio_target)
+            top = (img.height - new_height) // 2
+            img = img.crop((0, top, img.width, top + new_height))
+    return img
+
+def render_renditions(folder_path, filename, sizes, aspect_ratio='square'):
+    """Write a JPEG and a WebP file per rendition next to filename; runs in image_pool."""
+    stem = os.path.splitext(filename)[0]
+    renditions = {}
+    with Image.open(os.path.join(folder_path, filename)) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img = crop_to_aspect(img, aspect_ratio)
+
+        for name, size in sizes.items():
+            resized = img.resize(size, Image.LANCZOS)
+            resized.save(os.path.join(folder_path, f'{stem}_{name}.jpg'), 'JPEG', quality=85)
+            resized.save(os.path.join(folder_path, f'{stem}_{name}.webp'), 'WEBP', quality=80)
+            renditions[name] = f'{stem}_{name}'
+    return renditions
+
+def existing_renditions(folder, filename):
+    # Identical uploads share a content hash, so their renditions may already be on disk
+    stem = os.path.splitext(filename)[0]
+    folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
+    renditions = {name: f'{stem}_{name}' for name in app.config['IMAGE_RENDITIONS'][folder]}
+    for rendition in renditions.values():
+        for extension in ('jpg', 'webp'):
+            if not os.path.exists(os.path.join(folder_path, f'{rendition}.{extension}')):
+                return None
+    return renditions
+
+def process_image(folder, filename, aspect_ratio, on_done, obj_id):
+    # Renders off the request in image_pool, then on_done(obj_id, renditions or None) runs
+    # as a background task to record the result
+    started = time.perf_counter()
+    def finished(future):
+        route_metrics.record_image(folder, time.perf_counter() - started)
+        try:
+            renditions = future.result()
+        except Exception:
+            app.logger.exception('Image processing failed for %s/%s', folder, filename)
+            renditions = None
+        run_in_background(on_done, obj_id, renditions)
+
+    folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
+    sizes = app.config['IMAGE_RENDITIONS'][folder]
+    if app.config['BACKGROUND_TASKS_SYNC']:
+        future = Future()
+        try:
+            future.set_result(render_renditions(folder_path, filename, sizes, aspect_ratio))
+        except Exception as exc:
+            future.set_exception(exc)
+        finished(future)
+    else:
+        image_pool.submit(render_renditions, folder_path, filename, sizes,
+                          aspect_ratio).add_done_callback(finished)
+
+    stats = request_stats()
+    if stats is not None:
+        stats.image_time += time.perf_counter() - started
+
+def finish_post_image(post_id, renditions):
+    post = db.session.get(Post, post_id)
+    if post is None:
+        return
+    if renditions is None:
+        post.image_status = 'failed'
+    else:
+        post.image = renditions['full'] + '.jpg'
+        post.image_renditions = renditions
+        post.image_status = 'ready'
+    db.session.commit()
+
+def finish_profile_pic(user_id, renditions, filename):
+    # The previous picture stays in place until the new one is ready; an upload that
+    # failed to render, or whose user is gone, gives back its reference
+    user = db.session.get(User, user_id)
+    if user is None or renditions is None:
+        release_upload('profile_pics', filename)
+        db.session.commit()
+        return
+    if user.profile_pic:
+        release_upload('profile_pics', user.profile_pic)
+    user.profile_pic = renditions['full'] + '.jpg'
+    user.profile_pic_renditions = renditions
+    db.session.commit()
+
+# Fragment caching
+@app.template_global()
+def post_fragment(template_name, post, **context):
+    """Render the viewer-independent part of a post card, cached by post id and version."""
+    key = ':'.join([template_name, str(post.id), post.cache_version]
+                   + [f'{name}={value}' for name, value in sorted(context.items())])
+    html = fragment_cache.get(key)
+    if html is None:
+        # Rendered without the request context processors, so current_user can't leak in
+        html = app.jinja_env.get_template(template_name).render(post=post, **context)
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+# Upload storage
+def _upload_key(folder, filename):
+    # Renditions ('<hash>_<name>.jpg') and the original ('<hash>.<ext>') share one key
+    stem = os.path.splitext(filename)[0]
+    directory, _, name = stem.rpartition('/')
+    return f"{folder}/{directory}/{name.split('_', 1)[0]}"
+
+def store_upload(file, folder):
+    """Stream an uploaded file into sharded, content-addressed storage under folder.
+
+    Returns the stored filename relative to the folder ('ab/cd/<sha256>.<ext>'). Identical
+    bytes are stored once; each call takes a reference released by release_upload.
+    """
+    folder_path = os.path.join(app.config['UPLOAD_FOLDER'], folder)
+    extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(dir=folder_path, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(app.config['UPLOAD_CHUNK_SIZE']), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        content_hash = digest.hexdigest()
+        filename = f'{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{extension}'
+        file_path = os.path.join(folder_path, filename)
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    # Insert-if-missing then increment in SQL, so concurrent first uploads of the same
+    # bytes neither collide on the key nor lose a reference
+    key = _upload_key(folder, filename)
+    db.session.execute(insert_ignore(StoredFile.__table__),
+                       {'key': key, 'filename': filename, 'size': size, 'ref_count': 0})
+    db.session.execute(db.update(StoredFile).where(StoredFile.key == key)
+                       .values(ref_count=StoredFile.ref_count + 1))
+    return filename
+
+def release_upload(folder, filename):
+    # Files are only deleted by `flask prune-uploads`, never while a request may serve them
+    db.session.execute(db.update(StoredFile)
+                       .where(StoredFile.key == _upload_key(folder, filename))
+                       .values(ref_count=StoredFile.ref_count - 1))
+
+@app.template_global()
+def rendition_srcset(folder, renditions, extension):
+    sizes = app.config['IMAGE_RENDITIONS'][folder]
+    return ', '.join(
+        f"{url_for('static', filename=f'uploads/{folder}/{stem}.{extension}')} {sizes[name][0]}w"
+        for name, stem in renditions.items() if name in sizes)
+
+# Media
+# Servers whose wsgi.file_wrapper stops at Content-Length, so a byte range can go out through
+# sendfile() from a file positioned at its start; others (wsgiref) would send on to the end
+RANGE_FILE_WRAPPER_SERVERS = ('gunicorn', 'waitress')
+
+def read_range(file, length, chunk_size):
+    # Fallback body when the server has no wsgi.file_wrapper
+    with file:
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def media_response(filename):
+    """Serve an upload with conditional and Range/206 support, or hand it to the front proxy.
+
+    Whole files go through the server's wsgi.file_wrapper, which gunicorn and uWSGI send
+    with sendfile(); byte ranges do too on RANGE_FILE_WRAPPER_SERVERS.
+    """
+    path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    offload = app.config['MEDIA_OFFLOAD']
+    if offload == 'x-accel-redirect':
+        # nginx does the transfer, Range handling included, from an internal location
+        return Response(mimetype=mimetype, headers={
+            'X-Accel-Redirect': app.config['MEDIA_ACCEL_PREFIX'] + quote(filename)})
+    if offload == 'x-sendfile':
+        return Response(mimetype=mimetype, headers={'X-Sendfile': path})
+
+    stat = os.stat(path)
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stat.st_size
+    response.last_modified = datetime.utcfromtimestamp(stat.st_mtime)
+    response.set_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+    response.accept_ranges = 'bytes'
+    # Sets 304, 412, 416 or 206 (with Content-Range and Content-Length) from the request headers
+    response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    if response.status_code in (200, 206) and request.method != 'HEAD':
+        start = response.content_range.start if response.status_code == 206 else 0
+        file = open(path, 'rb')
+        file.seek(start)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+        if file_wrapper is not None and (response.status_code == 200 or request.environ.get(
+                'SERVER_SOFTWARE', '').lower().startswith(RANGE_FILE_WRAPPER_SERVERS)):
+            response.response = file_wrapper(file, chunk_size)
+        else:
+            response.response = read_range(file, response.content_length, chunk_size)
+    return response
+
+# Keyset pagination
+def encode_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{row_id}'.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        abort(400)
+
+def paginate(query, timestamp_col, id_col, cursor=None, ascending=False):
+    """Return one page of query ordered by (timestamp, id) and the cursor for the next page."""
+    per_page = app.config['PAGE_SIZE']
+    query = query.add_columns(timestamp_col, id_col)
+    if cursor:
+        # A row-value comparison, which the (..., timestamp, id) indexes can seek to
+        # directly instead of walking every row before the cursor
+        position = db.tuple_(timestamp_col, id_col)
+        after = decode_cursor(cursor)
+        query = query.filter(position > after if ascending else position < after)
+    if ascending:
+        query = query.order_by(timestamp_col.asc(), id_col.asc())
+    else:
+        query = query.order_by(timestamp_col.desc(), id_col.desc())
+
+    rows = query.limit(per_page + 1).all()
+    next_cursor = encode_cursor(*rows[per_page - 1][1:]) if len(rows) > per_page else None
+    return [row[0] for row in rows[:per_page]], next_cursor
+
+# Background tasks
+def run_in_background(func, *args):
+    def task():
+        with app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Background task %s failed', func.__name__)
+
+    if app.config['BACKGROUND_TASKS_SYNC']:
+        task()
+    else:
+        background_executor.submit(task)
+
+# Home timeline
+def _insert_feed_entries(post_select):
+    # post_select yields (user_id, post_id, timestamp) rows; ones already in the feed
+    # (say, left there by a backfill) are skipped instead of failing the whole insert.
+    # SQLite needs a WHERE before ON CONFLICT to parse INSERT ... SELECT
+    db.session.execute(insert_ignore(feed_entries).from_select(
+        ['user_id', 'post_id', 'timestamp'], post_select.where(db.true())))
+
+def fan_out_post(post_id):
+    post = db.session.get(Post, post_id)
+    if post is None:
+        return
+
+    if post.group_id:
+        recipients = (db.select(group_members.c.user_id)
+                      .where(group_members.c.group_id == post.group_id).distinct())
+    else:
+        recipients = db.select(db.literal(post.user_id))
+        # Large accounts are merged into their followers' feeds at read time instead
+        if post.author.followers_count <= app.config['FEED_FANOUT_LIMIT']:
+            recipients = db.union(recipients, db.select(followers_association.c.follower_id)
+                                  .where(followers_association.c.followed_id == post.user_id))
+    recipients = recipients.subquery()
+
+    _insert_feed_entries(db.select(recipients.c[0], db.literal(post.id), db.literal(post.timestamp)))
+    db.session.commit()
+
+def backfill_feed(user, author=None, group=None):
+    # Copy recent posts of a newly followed author / joined group into user's timeline
+    posts = db.select(Post.id, Post.timestamp)
+    if author is not None:
+        if author.id != user.id and author.followers_count > app.config['FEED_FANOUT_LIMIT']:
+            return
+        posts = posts.where(Post.user_id == author.id, Post.group_id == None)
+    else:
+        posts = posts.where(Post.group_id == group.id)
+    posts = (posts.where(Post.id.not_in(db.select(feed_entries.c.post_id)
+                                        .where(feed_entries.c.user_id == user.id)))
+             .order_by(Post.timestamp.desc()).limit(app.config['FEED_BACKFILL_SIZE']).subquery())
+    _insert_feed_entries(db.select(db.literal(user.id), posts.c.id, posts.c.timestamp))
+
+def purge_feed(user, author=None, group=None):
+    # Remove an unfollowed author's / left group's posts from user's timeline
+    posts = db.select(Post.id)
+    if author is not None:
+        posts = posts.where(Post.user_id == author.id, Post.group_id == None)
+    else:
+        posts = posts.where(Post.group_id == group.id)
+    db.session.execute(feed_entries.delete().where(feed_entries.c.user_id == user.id,
+                                                   feed_entries.c.post_id.in_(posts)))
+
+def load_feed(user, cursor=None):
+    posts, next_cursor = paginate(
+        Post.query.join(feed_entries, feed_entries.c.post_id == Post.id)
+        .filter(feed_entries.c.user_id == user.id)
+        .options(db.joinedload(Post.author), db.joinedload(Post.group)),
+        feed_entries.c.timestamp, feed_entries.c.post_id, cursor)
+
+    # Fan-out-on-read for followed accounts too large to fan out on write. Most readers
+    # follow none, and their feed stays the single feed_entries range read
+    large_authors = db.session.scalars(
+        db.select(followers_association.c.followed_id)
+        .join(User, User.id == followers_association.c.followed_id)
+        .where(followers_association.c.follower_id == user.id,
+               User.followers_count > app.config['FEED_FANOUT_LIMIT'])).all()
+    pulled, pulled_more = [], False
+    for author_id in large_authors:
+        # One page per author, each a range read on ix_post_user_group_timestamp
+        author_posts, author_cursor = paginate(
+            Post.query.filter(Post.user_id == author_id, Post.group_id == None)
+            .options(db.joinedload(Post.author)),
+            Post.timestamp, Post.id, cursor)
+        pulled += author_posts
+        pulled_more = pulled_more or author_cursor is not None
+    if pulled:
+        per_page = app.config['PAGE_SIZE']
+        merged = sorted({post.id: post for post in posts + pulled}.values(),
+                        key=lambda post: (post.timestamp, post.id), reverse=True)
+        has_more = next_cursor or pulled_more or len(merged) > per_page
+        posts = merged[:per_page]
+        next_cursor = encode_cursor(posts[-1].timestamp, posts[-1].id) if has_more else None
+    return posts, next_cursor
+
+# Live updates
+def sse_event(event, version, data):
+    return f'id: {version}\nevent: {event}\ndata: {json.dumps(data)}\n\n'
+
+class LiveUpdates:
+    """Pub/sub of like/comment counts and new comments per post, for the /live streams.
+
+    Updates are coalesced per post: only a post's latest counts are kept, plus a short
+    backlog of new comments, each serialized once and stamped with a version. Streams wake
+    on a change to a post they watch, send everything newer than what they last sent, then
+    wait LIVE_UPDATE_INTERVAL, so a burst of likes on a hot post costs each viewer one message.
+    With LIVE_UPDATES_BROKER = 'redis', updates travel through Redis pub/sub to every process.
+    """
+
+    channel = 'synapse:live'
+
+    def __init__(self):
+        self._posts = OrderedDict()  # post_id -> {'counts', 'counts_event', 'comments'}
+        self._version = 0
+        self._lock = Lock()
+        self._watchers = {}  # post_id -> wakeup Events of the streams watching it
+        self._streams = 0
+        self._redis = None
+        self._listener = None
+
+    @property
+    def streams(self):
+        return self._streams
+
+    def publish(self, post_id, likes=None, comments=None, comment=None):
+        message = {'post_id': post_id, 'likes': likes, 'comments': comments, 'comment': comment}
+        broker = self._broker()
+        if broker is None:
+            self.apply(message)
+        else:
+            broker.publish(self.channel, json.dumps(message))
+
+    def _broker(self):
+        # Redis client, once a thread applying updates published by any process is running
+        if app.config['LIVE_UPDATES_BROKER'] != 'redis':
+            return None
+        with self._lock:
+            if self._redis is None:
+                if redis is None:
+                    raise RuntimeError("LIVE_UPDATES_BROKER 'redis' requires the redis package")
+                client = redis.Redis.from_url(app.config['CACHE_REDIS_URL'])
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                def listen():
+                    for item in pubsub.listen():
+                        self.apply(json.loads(item['data']))
+                self._listener = Thread(target=listen, name='synapse-live', daemon=True)
+                self._listener.start()
+                self._redis = client
+            return self._redis
+
+    def apply(self, message):
+        post_id = message['post_id']
+        with self._lock:
+            self._version += 1
+            post = self._posts.pop(post_id, None) or {
+                'counts': {}, 'counts_event': None,
+                'comments': deque(maxlen=app.config['LIVE_COMMENT_BACKLOG'])}
+            self._posts[post_id] = post
+            counts = {name: message[name] for name in ('likes', 'comments') if message[name] is not None}
+            if counts:
+                post['counts'].update(counts)
+                post['counts_event'] = (self._version, sse_event(
+                    'counts', self._version, dict(post['counts'], post_id=post_id)))
+            if message['comment'] is not None:
+                post['comments'].append((self._version, sse_event(
+                    'comment', self._version, dict(message['comment'], post_id=post_id))))
+            while len(self._posts) > app.config['LIVE_TRACKED_POSTS']:
+                self._posts.popitem(last=False)
+            # Only streams watching this post wake up
+            for wakeup in self._watchers.get(post_id, ()):
+                wakeup.set()
+
+    def _changes(self, post_ids, since):
+        events = []
+        for post_id in post_ids:
+            post = self._posts.get(post_id)
+            if post is None:
+                continue
+            if post['counts_event'] and post['counts_event'][0] > since:
+                events.append(post['counts_event'])
+            events.extend(event for event in post['comments'] if event[0] > since)
+        return [chunk for _, chunk in sorted(events)]
+
+    def wait(self, post_ids, since, timeout, wakeup):
+        """Wait until one of post_ids changes after version since; returns (version, chunks).
+
+        wakeup is the calling stream's Event, registered for post_ids with watch().
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                chunks = self._changes(post_ids, since)
+                remaining = deadline - time.monotonic()
+                if chunks or remaining <= 0:
+                    return self._version, chunks
+                # Cleared under the lock, so a change applied from here on sets it again
+                wakeup.clear()
+            wakeup.wait(remaining)
+
+    def watch(self, post_ids, wakeup):
+        with self._lock:
+            for post_id in post_ids:
+                self._watchers.setdefault(post_id, set()).add(wakeup)
+
+    def unwatch(self, post_ids, wakeup):
+        with self._lock:
+            for post_id in post_ids:
+                watchers = self._watchers.get(post_id)
+                if watchers is not None:
+                    watchers.discard(wakeup)
+                    if not watchers:
+                        del self._watchers[post_id]
+
+    def stream(self, post_ids, since=None):
+        """Server-sent event chunks for post_ids, resuming after version since if given."""
+        self._broker()
+        wakeup = Event()
+        self.watch(post_ids, wakeup)
+        with self._lock:
+            self._streams += 1
+            if since is None or since > self._version:
+                since = self._version
+        try:
+            yield f"retry: {int(app.config['LIVE_UPDATE_INTERVAL'] * 1000) + 1000}\n\n"
+            deadline = time.monotonic() + app.config['LIVE_STREAM_DURATION']
+            while time.monotonic() < deadline:
+                since, chunks = self.wait(post_ids, since, app.config['LIVE_KEEPALIVE'], wakeup)
+                if not chunks:
+                    yield ': keepalive\n\n'
+                    continue
+                yield ''.join(chunks)
+                time.sleep(app.config['LIVE_UPDATE_INTERVAL'])
+        finally:
+            self.unwatch(post_ids, wakeup)
+            with self._lock:
+                self._streams -= 1
+
+live_updates = LiveUpdates()
+
+def publish_counts(post_ids):
+    # Sends the stored counts of post_ids to live streams; one query
+    for post_id, likes, comments in db.session.execute(
+            db.select(Post.id, Post.likes_count, Post.comments_count).where(Post.id.in_(post_ids))):
+        live_updates.publish(post_id, likes=likes, comments=comments)
+
+# Recommendations
+# People score: one point per followed user who follows them, plus 1/ln(size + 1) per
+# shared group of at most RECOMMENDATION_GROUP_SIZE_LIMIT members. Group score: one point
+# per followed user in the group. Self, followed, requested and joined are left out.
+def top_scores(scores):
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return ranked[:app.config['RECOMMENDATIONS_TOP_K']]
+
+def user_recommendations(user_id):
+    """Score people and groups for one user from their neighbourhood; returns two top-K lists."""
+    following = db.select(followers_association.c.followed_id).where(followers_association.c.follower_id == user_id)
+    requested = db.select(follow_requests.c.requested_id).where(follow_requests.c.requester_id == user_id)
+    joined = db.select(group_members.c.group_id).where(group_members.c.user_id == user_id)
+
+    people = Counter(db.session.scalars(
+        db.select(followers_association.c.followed_id)
+        .where(followers_association.c.follower_id.in_(following))))
+    sizes = db.session.execute(db.select(group_members.c.group_id, db.func.count())
+                               .where(group_members.c.group_id.in_(joined))
+                               .group_by(group_members.c.group_id)).all()
+    weights = {group_id: 1 / math.log(size + 1) for group_id, size in sizes
+               if size <= app.config['RECOMMENDATION_GROUP_SIZE_LIMIT']}
+    if weights:
+        for member_id, group_id in db.session.execute(
+                db.select(group_members.c.user_id, group_members.c.group_id)
+                .where(group_members.c.group_id.in_(weights))):
+            people[member_id] += weights[group_id]
+    groups = Counter(db.session.scalars(
+        db.select(group_members.c.group_id).where(group_members.c.user_id.in_(following))))
+
+    excluded = set(db.session.scalars(following.union(requested))) | {user_id}
+    joined_ids = set(db.session.scalars(joined))
+    return (top_scores({target: score for target, score in people.items() if target not in excluded}),
+            top_scores({target: score for target, score in groups.items() if target not in joined_ids}))
+
+def sparse_recommendations():
+    """Score every user with batched sparse matrix products; yields (user_id, people, groups)."""
+    user_ids = list(db.session.scalars(db.select(User.id).order_by(User.id)))
+    group_ids = list(db.session.scalars(db.select(Group.id).order_by(Group.id)))
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+    group_index = {group_id: i for i, group_id in enumerate(group_ids)}
+
+    def matrix(rows, columns, index, column_index):
+        # 0/1 matrix with a one for each (row id, column id) pair
+        pairs = numpy.array([(index[row], column_index[column]) for row, column in rows], dtype=int).reshape(-1, 2)
+        return sparse.csr_matrix((numpy.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                 shape=(len(index), columns))
+
+    follows = matrix(db.session.execute(db.select(followers_association.c.follower_id,
+                                                  followers_association.c.followed_id)),
+                     len(user_ids), user_index, user_index)
+    requests = matrix(db.session.execute(db.select(follow_requests.c.requester_id,
+                                                   follow_requests.c.requested_id)),
+                      len(user_ids), user_index, user_index)
+    members = matrix(db.session.execute(db.select(group_members.c.user_id, group_members.c.group_id)),
+                     len(group_ids), user_index, group_index)
+    sizes = numpy.asarray(members.sum(axis=0)).ravel()
+    weights = numpy.where((sizes > 0) & (sizes <= app.config['RECOMMENDATION_GROUP_SIZE_LIMIT']),
+                          1 / numpy.log(sizes + 1), 0)
+    members_t = members.T.tocsr()
+
+    def top(row_matrix, i, ids):
+        row = row_matrix.getrow(i)
+        order = numpy.lexsort((row.indices, -row.data))[:app.config['RECOMMENDATIONS_TOP_K']]
+        return [(ids[row.indices[j]], float(row.data[j])) for j in order]
+
+    batch_size = app.config['RECOMMENDATION_BATCH_SIZE']
+    for start in range(0, len(user_ids), batch_size):
+        batch = slice(start, start + batch_size)
+        followed = follows[batch]
+        people = (followed @ follows + members[batch].multiply(weights).tocsr() @ members_t).tocsr()
+        # Drop self, followed and requested users, then joined groups
+        own = sparse.csr_matrix((numpy.ones(people.shape[0]),
+                                 (numpy.arange(people.shape[0]), numpy.arange(start, start + people.shape[0]))),
+                                shape=people.shape)
+        people = people - people.multiply((followed + requests[batch] + own) > 0)
+        people.eliminate_zeros()
+        groups = (followed @ members).tocsr()
+        groups = groups - groups.multiply(members[batch] > 0)
+        groups.eliminate_zeros()
+        for i in range(people.shape[0]):
+            yield user_ids[start + i], top(people, i, user_ids), top(groups, i, group_ids)
+
+def store_recommendations(user_id, people, groups):
+    db.session.execute(recommendations.delete().where(recommendations.c.user_id == user_id))
+    rows = ([{'user_id': user_id, 'kind': 'user', 'target_id': target, 'score': score} for target, score in people]
+            + [{'user_id': user_id, 'kind': 'group', 'target_id': target, 'score': score} for target, score in groups])
+    if rows:
+        db.session.execute(recommendations.insert(), rows)
+
+def refresh_recommendations(user_id):
+    # Incremental refresh after the user follows, unfollows, joins or leaves
+    store_recommendations(user_id, *user_recommendations(user_id))
+    db.session.commit()
+
+def suggested(user, kind, model):
+    # A single indexed lookup on (user_id, kind, score)
+    return (model.query.join(recommendations, recommendations.c.target_id == model.id)
+            .filter(recommendations.c.user_id == user.id, recommendations.c.kind == kind)
+            .order_by(recommendations.c.score.desc(), model.id)
+            .limit(app.config['RECOMMENDATIONS_SHOWN']).all())
+
+# Trending
+# A post's hotness is log2(1 + weighted likes and comments) plus its age in half-lives
+# since RANKING_EPOCH: the log of an engagement score that halves every RANKING_HALF_LIFE
+# seconds, on a scale where the order never changes as time passes, so scores are only
+# rewritten when a post's counts do. A group's activity is the log of the sum of its posts'
+# scores on the same scale.
+RANKING_EPOCH = datetime(2024, 1, 1)
+
+ranking_cache = make_cache('ranking', 1000, app.config['RANKING_CACHE_TTL'])
+
+def post_hotness(likes_count, comments_count, timestamp):
+    engagement = (1 + app.config['RANKING_LIKE_WEIGHT'] * likes_count
+                  + app.config['RANKING_COMMENT_WEIGHT'] * comments_count)
+    return (math.log2(engagement)
+            + (timestamp - RANKING_EPOCH).total_seconds() / app.config['RANKING_HALF_LIFE'])
+
+def log2_add(total, add, remove=None):
+    """log2(2**total - 2**remove + 2**add); None stands for an empty sum or nothing to remove."""
+    if total is None:
+        return add
+    top = max(total, add)
+    if remove is None:
+        kept = 2 ** (total - top)
+    elif remove >= total:
+        kept = 0
+    else:
+        kept = 2 ** (total - top) - 2 ** (remove - top)
+    return top + math.log2(kept + 2 ** (add - top))
+
+def update_rankings(post_ids):
+    """Re-score post_ids from their stored counts and move their groups' activity to match.
+
+    Runs in the caller's transaction. Concurrent updates to one group can lose a step;
+    refresh-rankings recomputes every score from the posts.
+    """
+    rows = db.session.execute(db.select(Post.id, Post.group_id, Post.likes_count, Post.comments_count,
+                                        Post.timestamp, Post.hotness)
+                              .where(Post.id.in_(post_ids))).all()
+    if not rows:
+        return
+    scores = {row.id: post_hotness(row.likes_count, row.comments_count, row.timestamp) for row in rows}
+    db.session.execute(db.update(Post), [{'id': post_id, 'hotness': score} for post_id, score in scores.items()])
+    group_rows = [row for row in rows if row.group_id is not None]
+    if group_rows:
+        activity = dict(db.session.execute(db.select(Group.id, Group.activity)
+                                           .where(Group.id.in_({row.group_id for row in group_rows}))).all())
+        for row in group_rows:
+            activity[row.group_id] = log2_add(activity[row.group_id], scores[row.id], row.hotness)
+        db.session.execute(db.update(Group), [{'id': group_id, 'activity': score}
+                                              for group_id, score in activity.items()])
+
+def trending_candidates(group_id=None):
+    # Ids of the hottest posts overall or in one group; at most RANKING_CACHE_TTL seconds old
+    key = f'posts:{group_id or 0}'
+    post_ids = ranking_cache.get(key)
+    if post_ids is None:
+        query = db.select(Post.id).where(Post.hotness != None)
+        if group_id is not None:
+            query = query.where(Post.group_id == group_id)
+        post_ids = list(db.session.scalars(query.order_by(Post.hotness.desc())
+                                           .limit(app.config['RANKING_CANDIDATES'])))
+        ranking_cache.set(key, post_ids)
+    return post_ids
+
+def trending_posts(user, group_id=None):
+    """The hottest candidates the user can see; one indexed lookup plus one query."""
+    post_ids = trending_candidates(group_id)
+    if not post_ids:
+        return []
+    return (Post.query.filter(Post.id.in_(post_ids), Post.visible_to(user))
+            .options(db.joinedload(Post.author), db.joinedload(Post.group))
+            .order_by(Post.hotness.desc(), Post.id).limit(app.config['RANKING_SHOWN']).all())
+
+def active_groups():
+    group_ids = ranking_cache.get('groups')
+    if group_ids is None:
+        group_ids = list(db.session.scalars(db.select(Group.id).where(Group.activity != None)
+                                            .order_by(Group.activity.desc())
+                                            .limit(app.config['RANKING_SHOWN'])))
+        ranking_cache.set('groups', group_ids)
+    groups = Group.query.filter(Group.id.in_(group_ids)).all() if group_ids else []
+    groups.sort(key=lambda group: group_ids.index(group.id))
+    return groups
+
+# Likes
+def insert_ignore(table):
+    # INSERT that silently skips rows violating a unique key
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return db.insert(table).prefix_with('IGNORE')
+
+def apply_like(post_id, user_id, liked):
+    """Insert or delete one post_likes row by key; returns the change in like count."""
+    if liked:
+        result = db.session.execute(insert_ignore(post_likes).values(user_id=user_id, post_id=post_id))
+        return result.rowcount
+    result = db.session.execute(post_likes.delete().where(post_likes.c.user_id == user_id,
+                                                         post_likes.c.post_id == post_id))
+    return -result.rowcount
+
+def adjust_like_count(post_id, delta):
+    db.session.execute(db.update(Post).where(Post.id == post_id)
+                       .values(likes_count=Post.likes_count + delta))
+
+class LikeBuffer:
+    """Write-behind buffer that coalesces like/unlike bursts into batched transactions.
+
+    Only the latest state per (post, user) is kept, so a like followed by an unlike costs
+    nothing. A daemon thread flushes every LIKE_FLUSH_INTERVAL seconds, or sooner once
+    LIKE_BUFFER_SIZE events are pending.
+    """
+
+    def __init__(self):
+        self._pending = {}  # (post_id, user_id) -> liked
+        self._deltas = {}  # post_id -> expected change in likes_count
+        self._flushing = {}
+        self._flushing_deltas = {}
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+    def state(self, post_id, user_id):
+        with self._lock:
+            key = (post_id, user_id)
+            return self._pending.get(key, self._flushing.get(key))
+
+    def like_counts(self, post_ids):
+        """post_id -> stored like count plus the changes still buffered or being flushed."""
+        with self._lock:
+            # flush() commits and drops its in-flight deltas under this lock, so a batch is
+            # counted either in the stored count or in the deltas, never both
+            counts = db.session.execute(db.select(Post.id, Post.likes_count).where(Post.id.in_(post_ids)))
+            return {post_id: count + self._deltas.get(post_id, 0) + self._flushing_deltas.get(post_id, 0)
+                    for post_id, count in counts}
+
+    def record(self, post_id, user_id, liked, was_liked):
+        if liked == was_liked:
+            return
+        with self._lock:
+            self._pending[(post_id, user_id)] = liked
+            self._deltas[post_id] = self._deltas.get(post_id, 0) + (1 if liked else -1)
+            full = len(self._pending) >= app.config['LIKE_BUFFER_SIZE']
+            if self._thread is None and not app.config['BACKGROUND_TASKS_SYNC']:
+                self._thread = Thread(target=self._run, name='synapse-likes', daemon=True)
+                self._thread.start()
+
+        if app.config['BACKGROUND_TASKS_SYNC']:
+            self.flush()
+            return
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(app.config['LIKE_FLUSH_INTERVAL'])
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Flushing buffered likes failed')
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            batch = self._flushing = self._pending
+            self._flushing_deltas = self._deltas
+            self._pending, self._deltas = {}, {}
+
+        # Counts come from the rows actually changed, so other processes' writes stay exact
+        deltas = {}
+        try:
+            for (post_id, user_id), liked in batch.items():
+                deltas[post_id] = deltas.get(post_id, 0) + apply_like(post_id, user_id, liked)
+            changed = [post_id for post_id, delta in deltas.items() if delta]
+            for post_id in changed:
+                adjust_like_count(post_id, deltas[post_id])
+            if changed:
+                update_rankings(changed)
+            with self._lock:
+                db.session.commit()
+                self._flushing, self._flushing_deltas = {}, {}
+        except Exception:
+            # Put the batch back, keeping any newer events for the same keys
+            with self._lock:
+                for key, liked in batch.items():
+                    if key not in self._pending:
+                        self._pending[key] = liked
+                for post_id, delta in self._flushing_deltas.items():
+                    self._deltas[post_id] = self._deltas.get(post_id, 0) + delta
+                self._flushing, self._flushing_deltas = {}, {}
+            raise
+        if changed:
+            publish_counts(changed)
+
+like_buffer = LikeBuffer()
+
+def set_like(post_id, user_id, liked):
+    """Like or unlike a post without loading its likers; returns the resulting like count."""
+    likes_count = db.session.scalar(db.select(Post.likes_count).where(Post.id == post_id))
+    if likes_count is None:
+        abort(404)
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        was_liked = like_buffer.state(post_id, user_id)
+        if was_liked is None:
+            was_liked = db.session.scalar(db.select(post_likes.c.post_id).where(
+                post_likes.c.user_id == user_id, post_likes.c.post_id == post_id)) is not None
+        like_buffer.record(post_id, user_id, liked, was_liked)
+        if app.config['BACKGROUND_TASKS_SYNC']:
+            return db.session.scalar(db.select(Post.likes_count).where(Post.id == post_id))
+        return like_buffer.like_counts([post_id])[post_id]
+
+    delta = apply_like(post_id, user_id, liked)
+    if delta:
+        adjust_like_count(post_id, delta)
+        update_rankings([post_id])
+        db.session.commit()
+        likes_count = db.session.scalar(db.select(Post.likes_count).where(Post.id == post_id))
+        live_updates.publish(post_id, likes=likes_count)
+    return likes_count
+
+def set_likes(user, actions):
+    """Apply {post_id: liked} for user with a fixed number of statements.
+
+    Posts the user can't see are skipped; returns {post_id: like count} for the rest.
+    """
+    counts = dict(db.session.execute(db.select(Post.id, Post.likes_count)
+                                     .where(Post.id.in_(actions), Post.visible_to(user))).all())
+    if not counts:
+        return counts
+    liked_ids = set(db.session.scalars(db.select(post_likes.c.post_id).where(
+        post_likes.c.user_id == user.id, post_likes.c.post_id.in_(counts))))
+
+    if app.config['LIKE_WRITE_BEHIND']:
+        for post_id in counts:
+            was_liked = like_buffer.state(post_id, user.id)
+            if was_liked is None:
+                was_liked = post_id in liked_ids
+            like_buffer.record(post_id, user.id, actions[post_id], was_liked)
+        if not app.config['BACKGROUND_TASKS_SYNC']:
+            return like_buffer.like_counts(counts)
+        changed = list(counts)
+    else:
+        to_like = [post_id for post_id in counts if actions[post_id] and post_id not in liked_ids]
+        to_unlike = [post_id for post_id in counts if not actions[post_id] and post_id in liked_ids]
+        if to_like:
+            db.session.execute(insert_ignore(post_likes),
+                               [{'user_id': user.id, 'post_id': post_id} for post_id in to_like])
+        if to_unlike:
+            db.session.execute(post_likes.delete().where(post_likes.c.user_id == user.id,
+                                                         post_likes.c.post_id.in_(to_unlike)))
+        changed = to_like + to_unlike
+        if changed:
+            # Recounted from the rows, so concurrent single likes can't make it drift
+            like_total = (db.select(db.func.count()).select_from(post_likes)
+                          .where(post_likes.c.post_id == Post.id).scalar_subquery())
+            db.session.execute(db.update(Post).where(Post.id.in_(changed)).values(likes_count=like_total))
+            update_rankings(changed)
+            db.session.commit()
+
+    if changed:
+        counts.update(db.session.execute(db.select(Post.id, Post.likes_count)
+                                         .where(Post.id.in_(changed))).all())
+        if not app.config['LIKE_WRITE_BEHIND']:
+            for post_id in changed:
+                live_updates.publish(post_id, likes=counts[post_id])
+    return counts
+
+# Search
+class SearchBackend(ABC):
+    """Index of users, groups and posts; matches() returns a (ref_id, rank) subquery."""
+
+    # kind -> (model, title column, body column)
+    fields = {
+        'user': (User, User.username, User.bio),
+        'group': (Group, Group.name, Group.description),
+        'post': (Post, None, Post.content),
+    }
+
+    def index(self, kind, obj):
+        pass
+
+    @abstractmethod
+    def matches(self, kind, query):
+        pass
+
+    def rebuild(self):
+        pass
+
+class LikeSearchBackend(SearchBackend):
+    """Unindexed substring scan; works on any database."""
+
+    def matches(self, kind, query):
+        model, title, body = self.fields[kind]
+        pattern = f'%{query}%'
+        condition = body.ilike(pattern) if title is None else db.or_(title.ilike(pattern),
+                                                                     body.ilike(pattern))
+        return (db.select(model.id.label('ref_id'), db.literal(0).label('rank'))
+                .where(condition).subquery())
+
+class FTS5SearchBackend(SearchBackend):
+    """SQLite FTS5 inverted index, one virtual table per kind keyed by the row id."""
+
+    def __init__(self):
+        fts_metadata = db.MetaData()
+        self.tables = {kind: db.Table(f'search_{kind}', fts_metadata,
+                                      db.Column('rowid', db.Integer, primary_key=True),
+                                      db.Column('title', db.Text),
+                                      db.Column('body', db.Text))
+                       for kind in self.fields}
+        # Virtual tables are outside db.metadata, so hook them onto create_all/drop_all
+        db.event.listen(db.metadata, 'after_create', self._create_tables)
+        db.event.listen(db.metadata, 'before_drop', self._drop_tables)
+
+    def _create_tables(self, target, connection, **kw):
+        for table in self.tables.values():
+            connection.exec_driver_sql(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {table.name} USING fts5('
+                f"title, body, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+
+    def _drop_tables(self, target, connection, **kw):
+        for table in self.tables.values():
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {table.name}')
+
+    def index(self, kind, obj):
+        _, title, body = self.fields[kind]
+        table = self.tables[kind]
+        db.session.execute(table.delete().where(table.c.rowid == obj.id))
+        db.session.execute(table.insert().values(
+            rowid=obj.id,
+            title='' if title is None else getattr(obj, title.key) or '',
+            body=getattr(obj, body.key) or ''))
+
+    def matches(self, kind, query):
+        table = self.tables[kind]
+        # Every word becomes a quoted prefix term, so user input can't inject FTS syntax
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return (db.select(table.c.rowid.label('ref_id'), db.literal(0).label('rank'))
+                    .where(db.false()).subquery())
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return (db.select(table.c.rowid.label('ref_id'),
+                          db.func.bm25(db.literal_column(table.name), 4.0, 1.0).label('rank'))
+                .where(db.literal_column(table.name).op('MATCH')(match))
+                .subquery())
+
+    def rebuild(self):
+        for kind, (model, title, body) in self.fields.items():
+            table = self.tables[kind]
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                ['rowid', 'title', 'body'],
+                db.select(model.id, db.literal('') if title is None else db.func.coalesce(title, ''),
+                          db.func.coalesce(body, ''))))
+
+SEARCH_BACKENDS = {'fts5': FTS5SearchBackend, 'like': LikeSearchBackend}
+search_backend = SEARCH_BACKENDS[app.config['SEARCH_BACKEND']]()
+
+def search_page(query, kind, search_query, page):
+    """Return one page of ranked matches for query and whether there is a next page."""
+    per_page = app.config['PAGE_SIZE']
+    model = SearchBackend.fields[kind][0]
+    matches = search_backend.matches(kind, search_query)
+    results = (query.join(matches, matches.c.ref_id == model.id)
+               .order_by(matches.c.rank, model.id)
+               .offset((page - 1) * per_page).limit(per_page + 1).all())
+    return results[:per_page], len(results) > per_page
+
+# Bulk data
+# One flat record shape per kind, shared by export-data, import-data and /export. Users
+# and groups are referenced by username and name; posts carry their source id so comments
+# and likes can point at them. Kinds are listed in load order.
+BULK_KINDS = ('users', 'groups', 'follows', 'memberships', 'posts', 'comments', 'likes')
+
+def export_query(kind, user_id=None):
+    """Rows of one kind in key order; with user_id, only the rows belonging to that user."""
+    follower, followed = db.aliased(User), db.aliased(User)
+    if kind == 'users':
+        query = (db.select(User.username, User.email, User.bio, User.password.label('password_hash'))
+                 .order_by(User.id))
+        owned = User.id == user_id
+    elif kind == 'groups':
+        query = (db.select(Group.name, Group.description, User.username.label('creator'), Group.created_at)
+                 .join(User, User.id == Group.creator_id).order_by(Group.id))
+        owned = Group.creator_id == user_id
+    elif kind == 'follows':
+        query = (db.select(follower.username.label('follower'), followed.username.label('followed'),
+                           followers_association.c.timestamp)
+                 .join(follower, follower.id == followers_association.c.follower_id)
+                 .join(followed, followed.id == followers_association.c.followed_id)
+                 .order_by(followers_association.c.follower_id, followers_association.c.followed_id))
+        owned = db.or_(followers_association.c.follower_id == user_id,
+                       followers_association.c.followed_id == user_id)
+    elif kind == 'memberships':
+        query = (db.select(User.username.label('user'), Group.name.label('group'), group_members.c.timestamp)
+                 .join(User, User.id == group_members.c.user_id)
+                 .join(Group, Group.id == group_members.c.group_id)
+                 .order_by(group_members.c.user_id, group_members.c.group_id))
+        owned = group_members.c.user_id == user_id
+    elif kind == 'posts':
+        query = (db.select(Post.id, User.username.label('author'), Group.name.label('group'),
+                           Post.content, Post.timestamp)
+                 .join(User, User.id == Post.user_id).outerjoin(Group, Group.id == Post.group_id)
+                 .order_by(Post.id))
+        owned = Post.user_id == user_id
+    elif kind == 'comments':
+        query = (db.select(Comment.post_id, User.username.label('author'), Comment.content, Comment.timestamp)
+                 .join(User, User.id == Comment.user_id).order_by(Comment.id))
+        owned = Comment.user_id == user_id
+    else:
+        query = (db.select(post_likes.c.post_id, User.username.label('user'))
+                 .join(User, User.id == post_likes.c.user_id)
+                 .order_by(post_likes.c.user_id, post_likes.c.post_id))
+        owned = post_likes.c.user_id == user_id
+    return query if user_id is None else query.where(owned)
+
+def export_records(kind, user_id=None):
+    """Return the field names and a lazy iterator of records, fetched BULK_CHUNK_SIZE rows at a time."""
+    result = db.session.execute(export_query(kind, user_id)
+                                .execution_options(yield_per=app.config['BULK_CHUNK_SIZE']))
+    records = ({key: value.isoformat() if isinstance(value, datetime) else value
+                for key, value in row._mapping.items()} for row in result)
+    return list(result.keys()), records
+
+def write_records(out, fmt, fields, records):
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+    count = 0
+    for record in records:
+        if fmt == 'csv':
+            writer.writerow(record)
+        else:
+            out.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+def read_records(source, fmt):
+    """Yield records one at a time; empty CSV cells become None."""
+    if fmt == 'csv':
+        for row in csv.DictReader(source):
+            yield {key: value if value != '' else None for key, value in row.items()}
+    else:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+def record_format(stream, fmt=None):
+    # An explicit --format wins; otherwise go by the file extension, defaulting to NDJSON
+    return fmt or ('csv' if getattr(stream, 'name', '').endswith('.csv') else 'ndjson')
+
+def parse_timestamp(value):
+    return datetime.fromisoformat(value) if value else datetime.utcnow()
+
+# Scratch tables for one import-data run, kept out of db.metadata: the new id of each
+# imported post by its source id, and the users and groups refused because their name
+# (or email) was already taken
+import_metadata = db.MetaData()
+import_post_ids = db.Table('import_post_ids', import_metadata,
+                           db.Column('source_id', db.Integer, primary_key=True),
+                           db.Column('post_id', db.Integer, nullable=False))
+import_refused = db.Table('import_refused', import_metadata,
+                          db.Column('kind', db.String(10), primary_key=True),
+                          db.Column('name', db.String(120), primary_key=True))
+
+def lookup_ids(column, names):
+    # name -> id for the names that exist and weren't refused in this run, in one query per chunk
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    model = column.class_
+    refused = db.select(import_refused.c.name).where(import_refused.c.kind == model.__tablename__)
+    return dict(db.session.execute(db.select(column, model.id)
+                                   .where(column.in_(names), column.not_in(refused))).all())
+
+def imported_post_ids(records):
+    # source post id -> id the post was given by this run
+    source_ids = {int(record['post_id']) for record in records if record.get('post_id')}
+    if not source_ids:
+        return {}
+    return dict(db.session.execute(db.select(import_post_ids.c.source_id, import_post_ids.c.post_id)
+                                   .where(import_post_ids.c.source_id.in_(source_ids))).all())
+
+def refuse(kind, names):
+    # Report names that are already taken and remember them so later kinds skip their records
+    names = sorted(set(names))
+    for name in names:
+        click.echo(f'{kind}: {name!r} clashes with an existing {kind}, skipped', err=True)
+    if names:
+        db.session.execute(insert_ignore(import_refused),
+                           [{'kind': kind, 'name': name} for name in names])
+
+def insert_rows(table, rows):
+    # Number of rows actually inserted; rows that hit an existing key are skipped
+    if not rows:
+        return 0
+    return db.session.execute(insert_ignore(table), rows).rowcount
+
+def load_users(records):
+    records = [r for r in records
+               if r.get('username') and r.get('email') and (r.get('password_hash') or r.get('password'))]
+    taken = db.session.execute(db.select(User.username, User.email).where(db.or_(
+        User.username.in_({r['username'] for r in records}), User.email.in_({r['email'] for r in records})))).all()
+    usernames, emails = {username for username, _ in taken}, {email for _, email in taken}
+    refuse('user', (r['username'] for r in records if r['username'] in usernames or r['email'] in emails))
+    records = [r for r in records if r['username'] not in usernames and r['email'] not in emails]
+    hashes = password_hasher.hash_many([r['password'] for r in records if not r.get('password_hash')])
+    return insert_rows(User.__table__, [{'username': r['username'], 'email': r['email'], 'bio': r.get('bio'),
+                                         'password': r.get('password_hash') or next(hashes)} for r in records])
+
+def load_groups(records):
+    records = [r for r in records if r.get('name')]
+    taken = set(db.session.scalars(db.select(Group.name).where(Group.name.in_({r['name'] for r in records}))))
+    refuse('group', (r['name'] for r in records if r['name'] in taken))
+    creators = lookup_ids(User.username, (r.get('creator') for r in records))
+    return insert_rows(Group.__table__, [
+        {'name': r['name'], 'description': r.get('description'), 'creator_id': creators[r['creator']],
+         'created_at': parse_timestamp(r.get('created_at'))}
+        for r in records if r['name'] not in taken and r.get('creator') in creators])
+
+def load_follows(records):
+    users = lookup_ids(User.username, (name for r in records for name in (r.get('follower'), r.get('followed'))))
+    return insert_rows(followers_association, [
+        {'follower_id': users[r['follower']], 'followed_id': users[r['followed']],
+         'timestamp': parse_timestamp(r.get('timestamp'))}
+        for r in records
+        if r.get('follower') in users and r.get('followed') in users and r['follower'] != r['followed']])
+
+def load_memberships(records):
+    users = lookup_ids(User.username, (r.get('user') for r in records))
+    groups = lookup_ids(Group.name, (r.get('group') for r in records))
+    return insert_rows(group_members, [
+        {'user_id': users[r['user']], 'group_id': groups[r['group']],
+         'timestamp': parse_timestamp(r.get('timestamp'))}
+        for r in records if r.get('user') in users and r.get('group') in groups])
+
+def load_posts(records):
+    authors = lookup_ids(User.username, (r.get('author') for r in records))
+    groups = lookup_ids(Group.name, (r.get('group') for r in records))
+    records = [r for r in records
+               if r.get('author') in authors and r.get('content') and (not r.get('group') or r['group'] in groups)]
+    if not records:
+        return 0
+    # Posts always get new ids, each paired back with its source id
+    rows = [{'user_id': authors[r['author']], 'group_id': groups[r['group']] if r.get('group') else None,
+             'content': r['content'], 'timestamp': parse_timestamp(r.get('timestamp'))} for r in records]
+    table = Post.__table__
+    if db.session.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        # One statement, RETURNING the ids in parameter order
+        post_ids = db.session.scalars(db.insert(table).returning(table.c.id, sort_by_parameter_order=True),
+                                      rows).all()
+    else:
+        # No ordered RETURNING (MySQL): one statement per post, reading back its key
+        post_ids = [db.session.execute(db.insert(table), row).inserted_primary_key[0] for row in rows]
+    insert_rows(import_post_ids, [{'source_id': int(r['id']), 'post_id': post_id}
+                                  for r, post_id in zip(records, post_ids) if r.get('id')])
+    return len(post_ids)
+
+def load_comments(records):
+    authors = lookup_ids(User.username, (r.get('author') for r in records))
+    post_ids = imported_post_ids(records)
+    return insert_rows(Comment.__table__, [
+        {'post_id': post_ids[int(r['post_id'])], 'user_id': authors[r['author']], 'content': r['content'],
+         'timestamp': parse_timestamp(r.get('timestamp'))}
+        for r in records
+        if r.get('author') in authors and r.get('content') and r.get('post_id')
+        and int(r['post_id']) in post_ids])
+
+def load_likes(records):
+    users = lookup_ids(User.username, (r.get('user') for r in records))
+    post_ids = imported_post_ids(records)
+    return insert_rows(post_likes, [
+        {'user_id': users[r['user']], 'post_id': post_ids[int(r['post_id'])]}
+        for r in records if r.get('user') in users and r.get('post_id') and int(r['post_id']) in post_ids])
+
+# kind -> record loader; loaders resolve references, drop records that don't resolve and
+# return the number of rows inserted
+BULK_LOADERS = {
+    'users': load_users,
+    'groups': load_groups,
+    'follows': load_follows,
+    'memberships': load_memberships,
+    'posts': load_posts,
+    'comments': load_comments,
+    'likes': load_likes,
+}
+
+def import_records(kind, records):
+    """Insert records in BULK_CHUNK_SIZE chunks, one commit each; returns (read, inserted).
+
+    Only the rows themselves are written: counters, timelines, the search index and
+    suggestions are left for the caller to rebuild once the whole load is in. Expects
+    the scratch tables in import_metadata to exist.
+    """
+    load = BULK_LOADERS[kind]
+    records = iter(records)
+    read = inserted = 0
+    for chunk in iter(lambda: list(islice(records, app.config['BULK_CHUNK_SIZE'])), []):
+        inserted += load(chunk)
+        db.session.commit()
+        read += len(chunk)
+    return read, inserted
+
+# Conditional GET
+# Stored uploads and their renditions: '<folder>/ab/cd/<sha256>[_<rendition>].<ext>'
+CONTENT_ADDRESSED_UPLOAD = re.compile(r'uploads/[\w-]+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(_\w+)?\.\w+')
+
+def page_not_modified(*stamps, last_modified=None):
+    """Tag the page about to be rendered with an ETag built from stamps and the viewer.
+
+    Returns True when the client already holds this version, so the route can answer 304
+    without rendering. Pages with pending flashed messages are never tagged.
+    """
+    if session.get('_flashes'):
+        return False
+    etag = hashlib.sha1(repr((current_user.get_id(), request.full_path) + stamps).encode()).hexdigest()
+    g.page_validators = (etag, last_modified)
+    return request.if_none_match.contains(etag)
+
+@app.after_request
+def add_cache_headers(response):
+    validators = g.pop('page_validators', None)
+    if validators and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        # Per-viewer pages: browsers may keep them but must revalidate every time
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    elif (request.endpoint in ('static', 'media') and response.status_code in (200, 206, 304)
+          and CONTENT_ADDRESSED_UPLOAD.fullmatch(('uploads/' if request.endpoint == 'media' else '')
+                                                 + request.view_args.get('filename', ''))):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['UPLOAD_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+def latest(*timestamps):
+    return max((t for t in timestamps if t), default=None)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mov'}
 
@@ -204,6 +2125,8 @@ def allowed_file(filename):
 # Routes
 @app.route('/')
 def home():
+    if current_user.is_authenticated:
+        return redirect(url_for('feed'))
     return redirect(url_for('signin'))
 
 @app.route('/signup', methods=['GET', 'POST'])
@@ -232,9 +2155,11 @@ def signup():
             return redirect(url_for('signup'))
 
         # Hash the password
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         new_user = User(username=username, email=email, password=hashed_password)
         db.session.add(new_user)
+        db.session.flush()
+        search_backend.index('user', new_user)
         db.session.commit()
 
         flash('Account created successfully. Please sign in.', 'success')
@@ -251,12 +2176,20 @@ def signin():
         username = request.form['username']
         password = request.form['password']
 
+        if signin_throttle.blocked(username, request.remote_addr):
+            flash('Too many failed sign-in attempts. Please try again later.', 'error')
+            return render_template('signin.html'), 429
+
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        if user and password_hasher.verify(user.password, password):
+            signin_throttle.succeeded(username)
+            if password_hasher.needs_rehash(user.password):
+                run_in_background(upgrade_password_hash, user.id, password)
             login_user(user)
             flash('Signed in successfully!', 'success')
             return redirect(url_for('profile', username=user.username))
         else:
+            signin_throttle.failed(username, request.remote_addr)
             flash('Invalid username or password.', 'error')
 
     return render_template('signin.html')
@@ -270,43 +2203,62 @@ def signout():
 
 @app.route('/profile/<username>')
 @login_required
+@read_replica
 def profile(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    # populate_existing: on one's own profile the row is already in the session as
+    # current_user, holding load_user's cached and possibly stale column values
+    user = User.query.filter_by(username=username).populate_existing().first_or_404()
     
     # Check if the current user is the owner of the profile
     is_own_profile = current_user.username == username
     is_follower = current_user.is_following(user)
     
     if is_own_profile or is_follower:
-        posts = user.posts.filter(Post.group_id == None).order_by(Post.timestamp.desc()).all()
+        posts, next_cursor = paginate(user.posts.filter(Post.group_id == None),
+                                      Post.timestamp, Post.id, request.args.get('cursor'))
     else:
-        posts = []
+        posts, next_cursor = [], None
+
+    if page_not_modified(user.bio, user.profile_pic, user.profile_pic_renditions,
+                         user.followers_count, user.following_count,
+                         is_follower, current_user.has_sent_request(user),
+                         sorted(current_user.relationships.received_request_ids) if is_own_profile else None,
+                         sorted(user.relationships.group_ids),
+                         [(post.id, post.cache_version) for post in posts], next_cursor,
+                         last_modified=latest(*(post.timestamp for post in posts))):
+        return '', 304
 
     groups = user.groups
+    follow_requests = current_user.follow_requests.all() if is_own_profile else []
 
     return render_template('profile.html', user=user, posts=posts, 
                            is_own_profile=is_own_profile, is_follower=is_follower,
-                           groups=groups)
+                           groups=groups, next_cursor=next_cursor,
+                           follow_requests=follow_requests)
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
+    # The form starts from the stored bio, not load_user's cached copy
+    db.session.refresh(current_user)
     if request.method == 'POST':
         current_user.bio = request.form['bio']
         
+        filename = None
         if 'profile_pic' in request.files:
             file = request.files['profile_pic']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'profile_pics', filename)
-                file.save(file_path)
-                
-                resize_and_crop(file_path, (320, 180), aspect_ratio='16:9')
-                
-                current_user.profile_pic = filename
+                filename = store_upload(file, 'profile_pics')
 
+        search_backend.index('user', current_user)
         db.session.commit()
+        if filename:
+            renditions = existing_renditions('profile_pics', filename)
+            if renditions:
+                finish_profile_pic(current_user.id, renditions, filename)
+            else:
+                process_image('profile_pics', filename, '16:9',
+                              partial(finish_profile_pic, filename=filename), current_user.id)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('profile', username=current_user.username))
 
@@ -314,11 +2266,17 @@ def edit_profile():
 
 @app.route('/search', methods=['GET', 'POST'])
 @login_required
+@read_replica
 def search():
-    if request.method == 'POST':
-        search_query = request.form['search_query']
-        users = User.query.filter(User.username.ilike(f'%{search_query}%')).all()
-        return render_template('search_results.html', users=users, query=search_query)
+    search_query = request.values.get('search_query')
+    if search_query:
+        page = max(request.args.get('page', 1, type=int), 1)
+        users, more_users = search_page(User.query, 'user', search_query, page)
+        posts, more_posts = search_page(
+            Post.query.filter(Post.visible_to(current_user)).options(db.joinedload(Post.author)),
+            'post', search_query, page)
+        return render_template('search_results.html', users=users, posts=posts, query=search_query,
+                               page=page, has_next=more_users or more_posts)
     return render_template('search.html')
 
 @app.route('/send_follow_request/<int:user_id>')
@@ -332,6 +2290,7 @@ def send_follow_request(user_id):
     else:
         current_user.send_follow_request(user_to_follow)
         db.session.commit()
+        run_in_background(refresh_recommendations, current_user.id)
         flash('Follow request sent.', 'success')
     return redirect(url_for('profile', username=user_to_follow.username))
 
@@ -341,7 +2300,10 @@ def accept_follow_request(user_id):
     user = User.query.get_or_404(user_id)
     if current_user.has_received_request(user):
         current_user.accept_follow_request(user)
+        db.session.flush()
+        backfill_feed(user, author=current_user)
         db.session.commit()
+        run_in_background(refresh_recommendations, user.id)
         flash('Follow request accepted.', 'success')
     else:
         flash('No follow request from this user.', 'error')
@@ -354,6 +2316,7 @@ def decline_follow_request(user_id):
     if current_user.has_received_request(user):
         current_user.decline_follow_request(user)
         db.session.commit()
+        run_in_background(refresh_recommendations, user.id)
         flash('Follow request declined.', 'success')
     else:
         flash('No follow request from this user.', 'error')
@@ -365,7 +2328,9 @@ def unfollow(user_id):
     user_to_unfollow = User.query.get_or_404(user_id)
     if current_user.is_following(user_to_unfollow):
         current_user.unfollow(user_to_unfollow)
+        purge_feed(current_user, author=user_to_unfollow)
         db.session.commit()
+        run_in_background(refresh_recommendations, current_user.id)
         flash('You have unfollowed this user.', 'success')
     else:
         flash('You are not following this user.', 'error')
@@ -373,20 +2338,58 @@ def unfollow(user_id):
 
 @app.route('/followers/<username>')
 @login_required
+@read_replica
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
-    followers = user.followers.all()
-    return render_template('followers.html', user=user, followers=followers)
+    followers, next_cursor = paginate(user.followers, followers_association.c.timestamp,
+                                      User.id, request.args.get('cursor'))
+    if page_not_modified([u.id for u in followers], next_cursor):
+        return '', 304
+    return render_template('followers.html', user=user, followers=followers,
+                           next_cursor=next_cursor)
 
 @app.route('/following/<username>')
 @login_required
+@read_replica
 def following(username):
     user = User.query.filter_by(username=username).first_or_404()
-    following = user.following.all()
-    return render_template('following.html', user=user, following=following)
+    following, next_cursor = paginate(user.following, followers_association.c.timestamp,
+                                      User.id, request.args.get('cursor'))
+    if page_not_modified([u.id for u in following], next_cursor):
+        return '', 304
+    return render_template('following.html', user=user, following=following,
+                           next_cursor=next_cursor)
 
 
 
+@app.route('/feed')
+@login_required
+@read_replica
+def feed():
+    posts, next_cursor = load_feed(current_user, request.args.get('cursor'))
+    liked_post_ids = current_user.liked_post_ids(posts)
+    return render_template('feed.html', posts=posts, liked_post_ids=liked_post_ids,
+                           next_cursor=next_cursor,
+                           suggested_users=suggested(current_user, 'user', User),
+                           suggested_groups=suggested(current_user, 'group', Group))
+
+@app.route('/media/<path:filename>')
+def media(filename):
+    """Uploaded videos and other large media; see media_response."""
+    return media_response(filename)
+
+@app.route('/trending')
+@login_required
+@read_replica
+def trending():
+    group = None
+    group_id = request.args.get('group_id', type=int)
+    if group_id is not None:
+        group = Group.query.get_or_404(group_id)
+    posts = trending_posts(current_user, group_id)
+    groups = [] if group else active_groups()
+    return render_template('trending.html', posts=posts, groups=groups, group=group)
+
 @app.route('/create_post', methods=['GET', 'POST'])
 @login_required
 def create_post():
@@ -400,27 +2403,32 @@ def create_post():
 
         if group_id:
             group = Group.query.get(group_id)
-            if group and current_user in group.members:
+            if group and current_user.is_member(group):
                 post.group = group
             else:
                 flash('You cannot post in this group.', 'error')
                 return redirect(url_for('profile', username=current_user.username))
 
         if image and allowed_file(image.filename):
-            filename = secure_filename(image.filename)
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            image.save(image_path)
-            resize_and_crop(image_path, (800, 450), aspect_ratio='16:9')
-            post.image = filename
+            post.image = store_upload(image, 'posts')
+            post.image_renditions = existing_renditions('posts', post.image)
+            if post.image_renditions:
+                post.image = post.image_renditions['full'] + '.jpg'
+                post.image_status = 'ready'
+            else:
+                post.image_status = 'processing'
 
         if video and allowed_file(video.filename):
-            filename = secure_filename(video.filename)
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            video.save(video_path)
-            post.video = filename
+            post.video = store_upload(video, 'posts')
 
         db.session.add(post)
+        db.session.flush()
+        search_backend.index('post', post)
+        update_rankings([post.id])
         db.session.commit()
+        if post.image_status == 'processing':
+            process_image('posts', post.image, '16:9', finish_post_image, post.id)
+        run_in_background(fan_out_post, post.id)
         flash('Your post has been created!', 'success')
         
         if group_id:
@@ -433,13 +2441,14 @@ def create_post():
 
 @app.route('/post/<int:post_id>')
 @login_required
+@read_replica
 def view_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(db.joinedload(Post.author), db.joinedload(Post.group)).get_or_404(post_id)
     
     # Check if the post belongs to a group
     if post.group:
         # If it's a group post, check if the current user is a member of the group
-        if current_user not in post.group.members:
+        if not current_user.is_member(post.group):
             flash('You must be a member of the group to view this post.', 'error')
             return redirect(url_for('view_group', group_id=post.group.id))
     else:
@@ -448,25 +2457,27 @@ def view_post(post_id):
             flash('You need to follow the user to view this post.', 'error')
             return redirect(url_for('profile', username=post.author.username))
 
-    return render_template('view_post.html', post=post)
+    comments, next_cursor = paginate(post.comments.options(db.joinedload(Comment.user)),
+                                     Comment.timestamp, Comment.id, request.args.get('cursor'),
+                                     ascending=True)
+    liked_post_ids = current_user.liked_post_ids([post])
+    if page_not_modified(post.cache_version, sorted(liked_post_ids),
+                         [comment.id for comment in comments], next_cursor,
+                         last_modified=latest(post.timestamp, *(c.timestamp for c in comments))):
+        return '', 304
+
+    return render_template('view_post.html', post=post, comments=comments,
+                           liked_post_ids=liked_post_ids, next_cursor=next_cursor)
 
 @app.route('/like/<int:post_id>', methods=['POST'])
 @login_required
 def like_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    if current_user not in post.likes:
-        post.likes.append(current_user)
-        db.session.commit()
-    return jsonify({'likes': len(post.likes)})
+    return jsonify({'likes': set_like(post_id, current_user.id, liked=True)})
 
 @app.route('/unlike/<int:post_id>', methods=['POST'])
 @login_required
 def unlike_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    if current_user in post.likes:
-        post.likes.remove(current_user)
-        db.session.commit()
-    return jsonify({'likes': len(post.likes)})
+    return jsonify({'likes': set_like(post_id, current_user.id, liked=False)})
 
 @app.route('/comment/<int:post_id>', methods=['POST'])
 @login_required
@@ -476,7 +2487,13 @@ def add_comment(post_id):
     if content:
         comment = Comment(content=content, user=current_user, post=post)
         db.session.add(comment)
+        post.comments_count = Post.comments_count + 1
+        db.session.flush()
+        update_rankings([post_id])
         db.session.commit()
+        live_updates.publish(post_id, comments=post.comments_count, comment={
+            'id': comment.id, 'user': current_user.username, 'content': comment.content,
+            'timestamp': comment.timestamp.strftime('%Y-%m-%d %H:%M:%S')})
     return redirect(url_for('view_post', post_id=post_id))
 
 
@@ -495,6 +2512,8 @@ def create_group():
         new_group = Group(name=name, description=description, creator=current_user)
         new_group.members.append(current_user)
         db.session.add(new_group)
+        db.session.flush()
+        search_backend.index('group', new_group)
         db.session.commit()
         
         flash('Group created successfully!', 'success')
@@ -504,24 +2523,38 @@ def create_group():
 
 @app.route('/group/<int:group_id>')
 @login_required
+@read_replica
 def view_group(group_id):
     group = Group.query.get_or_404(group_id)
-    is_member = current_user in group.members
+    is_member = current_user.is_member(group)
 
     if is_member:
-        posts = group.posts.order_by(Post.timestamp.desc()).all()
+        posts, next_cursor = paginate(group.posts.options(db.joinedload(Post.author)),
+                                      Post.timestamp, Post.id, request.args.get('cursor'))
     else:
-        posts = []
-
-    return render_template('view_group.html', group=group, posts=posts, is_member=is_member)
+        posts, next_cursor = [], None
+    liked_post_ids = current_user.liked_post_ids(posts)
+    member_count = group.members.count()
+    if page_not_modified(is_member, member_count, sorted(liked_post_ids),
+                         [(post.id, post.cache_version) for post in posts], next_cursor,
+                         last_modified=latest(group.created_at, *(post.timestamp for post in posts))):
+        return '', 304
+
+    return render_template('view_group.html', group=group, posts=posts, is_member=is_member,
+                           member_count=member_count, liked_post_ids=liked_post_ids,
+                           next_cursor=next_cursor)
 
 @app.route('/join_group/<int:group_id>')
 @login_required
 def join_group(group_id):
     group = Group.query.get_or_404(group_id)
-    if current_user not in group.members:
+    if not current_user.is_member(group):
         group.members.append(current_user)
+        current_user.reset_relationships()
+        db.session.flush()
+        backfill_feed(current_user, group=group)
         db.session.commit()
+        run_in_background(refresh_recommendations, current_user.id)
         flash('You have joined the group successfully!', 'success')
     else:
         flash('You are already a member of this group.', 'info')
@@ -531,9 +2564,12 @@ def join_group(group_id):
 @login_required
 def leave_group(group_id):
     group = Group.query.get_or_404(group_id)
-    if current_user in group.members:
+    if current_user.is_member(group):
         group.members.remove(current_user)
+        current_user.reset_relationships()
+        purge_feed(current_user, group=group)
         db.session.commit()
+        run_in_background(refresh_recommendations, current_user.id)
         flash('You have left the group.', 'success')
     else:
         flash('You are not a member of this group.', 'error')
@@ -543,7 +2579,7 @@ def leave_group(group_id):
 @login_required
 def create_group_post(group_id):
     group = Group.query.get_or_404(group_id)
-    if current_user not in group.members:
+    if not current_user.is_member(group):
         flash('You must be a member of the group to create a post.', 'error')
         return redirect(url_for('view_group', group_id=group_id))
 
@@ -555,20 +2591,25 @@ def create_group_post(group_id):
         post = Post(content=content, author=current_user, group=group)
 
         if image and allowed_file(image.filename):
-            filename = secure_filename(image.filename)
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            image.save(image_path)
-            resize_and_crop(image_path, (800, 450), aspect_ratio='16:9')
-            post.image = filename
+            post.image = store_upload(image, 'posts')
+            post.image_renditions = existing_renditions('posts', post.image)
+            if post.image_renditions:
+                post.image = post.image_renditions['full'] + '.jpg'
+                post.image_status = 'ready'
+            else:
+                post.image_status = 'processing'
 
         if video and allowed_file(video.filename):
-            filename = secure_filename(video.filename)
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], 'posts', filename)
-            video.save(video_path)
-            post.video = filename
+            post.video = store_upload(video, 'posts')
 
         db.session.add(post)
+        db.session.flush()
+        search_backend.index('post', post)
+        update_rankings([post.id])
         db.session.commit()
+        if post.image_status == 'processing':
+            process_image('posts', post.image, '16:9', finish_post_image, post.id)
+        run_in_background(fan_out_post, post.id)
         flash('Your post has been created!', 'success')
         return redirect(url_for('view_group', group_id=group_id))
 
@@ -576,13 +2617,600 @@ def create_group_post(group_id):
 
 @app.route('/search_groups', methods=['GET', 'POST'])
 @login_required
+@read_replica
 def search_groups():
-    if request.method == 'POST':
-        search_query = request.form['search_query']
-        groups = Group.query.filter(Group.name.ilike(f'%{search_query}%')).all()
-        return render_template('search_groups_results.html', groups=groups, query=search_query)
+    search_query = request.values.get('search_query')
+    if search_query:
+        page = max(request.args.get('page', 1, type=int), 1)
+        groups, has_next = search_page(Group.query, 'group', search_query, page)
+        return render_template('search_groups_results.html', groups=groups, query=search_query,
+                               page=page, has_next=has_next)
     return render_template('search_groups.html')
 
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return (route_metrics.render() + password_hasher.render_metrics(), 200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+@app.route('/export')
+@login_required
+def export_account():
+    """Download everything the signed-in user has created, streamed as NDJSON."""
+    user_id = current_user.id
+    def lines():
+        for kind in BULK_KINDS:
+            _, records = export_records(kind, user_id)
+            for record in records:
+                record.pop('password_hash', None)
+                yield json.dumps({'type': kind, **record}) + '\n'
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename="{current_user.username}.ndjson"'})
+
+# JSON API
+# Versioned under /api/v1; every endpoint runs a fixed number of queries whatever the batch size
+API_PREFIX = '/api/v1'
+
+@app.errorhandler(HTTPException)
+def api_error(error):
+    if request.path.startswith(API_PREFIX + '/'):
+        return jsonify({'error': error.description}), error.code
+    return error
+
+def api_login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+def api_ids(values):
+    """Parse a list of ids, capped at API_BATCH_LIMIT, keeping the caller's order."""
+    try:
+        ids = list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        abort(400, 'ids must be integers')
+    if len(ids) > app.config['API_BATCH_LIMIT']:
+        abort(400, f"at most {app.config['API_BATCH_LIMIT']} ids per request")
+    return ids
+
+def query_ids():
+    return api_ids(value for value in request.args.get('ids', '').split(',') if value)
+
+def post_json(post, liked_post_ids):
+    data = {
+        'id': post.id,
+        'author': {'id': post.author.id, 'username': post.author.username},
+        'content': post.content,
+        'timestamp': post.timestamp.isoformat(),
+        'likes': post.likes_count,
+        'comments': post.comments_count,
+        'liked': post.id in liked_post_ids,
+    }
+    if post.group_id:
+        data['group_id'] = post.group_id
+    if post.image:
+        data['image_status'] = post.image_status
+        if post.image_status not in ('processing', 'failed'):
+            data['image'] = url_for('static', filename='uploads/posts/' + post.image)
+    if post.video:
+        data['video'] = url_for('media', filename='posts/' + post.video)
+    return data
+
+@app.route(API_PREFIX + '/posts')
+@api_login_required
+@read_replica
+def api_posts():
+    """Posts by id, in the order asked; ids that are missing or not visible are left out."""
+    ids = query_ids()
+    posts = (Post.query.filter(Post.id.in_(ids), Post.visible_to(current_user))
+             .options(db.joinedload(Post.author)).all()) if ids else []
+    posts.sort(key=lambda post: ids.index(post.id))
+    liked_post_ids = current_user.liked_post_ids(posts)
+    return jsonify({'posts': [post_json(post, liked_post_ids) for post in posts]})
+
+@app.route(API_PREFIX + '/feed')
+@api_login_required
+@read_replica
+def api_feed():
+    posts, next_cursor = load_feed(current_user, request.args.get('cursor'))
+    liked_post_ids = current_user.liked_post_ids(posts)
+    return jsonify({'posts': [post_json(post, liked_post_ids) for post in posts],
+                    'next_cursor': next_cursor})
+
+@app.route(API_PREFIX + '/trending')
+@api_login_required
+@read_replica
+def api_trending():
+    """Hottest posts the caller can see, overall or in ?group_id=, and the most active groups."""
+    group_id = request.args.get('group_id', type=int)
+    posts = trending_posts(current_user, group_id)
+    liked_post_ids = current_user.liked_post_ids(posts)
+    data = {'posts': [post_json(post, liked_post_ids) for post in posts]}
+    if group_id is None:
+        data['groups'] = [{'id': group.id, 'name': group.name} for group in active_groups()]
+    return jsonify(data)
+
+@app.route(API_PREFIX + '/follow_status')
+@api_login_required
+@read_replica
+def api_follow_status():
+    """Which of the given user ids the viewer follows, has asked to follow, or was asked by."""
+    ids = query_ids()
+    relationships = current_user.relationships
+    return jsonify({
+        'following': [user_id for user_id in ids if user_id in relationships.following_ids],
+        'requested': [user_id for user_id in ids if user_id in relationships.sent_request_ids],
+        'requested_by': [user_id for user_id in ids if user_id in relationships.received_request_ids],
+    })
+
+@app.route(API_PREFIX + '/live')
+@api_login_required
+def api_live():
+    """Server-sent events: 'counts' and 'comment' updates for the visible posts in ?posts=1,2,3."""
+    requested = api_ids(value for value in request.args.get('posts', '').split(',') if value)
+    post_ids = set(db.session.scalars(db.select(Post.id).where(
+        Post.id.in_(requested), Post.visible_to(current_user)))) if requested else set()
+    if live_updates.streams >= app.config['LIVE_MAX_STREAMS']:
+        abort(503, 'too many live streams open, try again later')
+    return Response(live_updates.stream(post_ids, request.headers.get('Last-Event-ID', type=int)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route(API_PREFIX + '/likes', methods=['POST'])
+@api_login_required
+def api_likes():
+    """Apply [{"post_id": 1, "liked": true}, ...]; later actions on a post win over earlier ones."""
+    actions = (request.get_json(silent=True) or {}).get('actions')
+    if not isinstance(actions, list) or not all(
+            isinstance(action, dict) and isinstance(action.get('liked'), bool) for action in actions):
+        abort(400, 'expected {"actions": [{"post_id": <id>, "liked": <bool>}, ...]}')
+    api_ids(action.get('post_id') for action in actions)
+    liked = {int(action['post_id']): action['liked'] for action in actions}
+    counts = set_likes(current_user, liked) if liked else {}
+    return jsonify({'likes': {str(post_id): count for post_id, count in counts.items()}})
+
+# CLI commands
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute the denormalized like/comment/follow counters from source tables."""
+    like_total = (db.select(db.func.count()).select_from(post_likes)
+                  .where(post_likes.c.post_id == Post.id).scalar_subquery())
+    comment_total = (db.select(db.func.count()).select_from(Comment)
+                     .where(Comment.post_id == Post.id).scalar_subquery())
+    follower_total = (db.select(db.func.count()).select_from(followers_association)
+                      .where(followers_association.c.followed_id == User.id).scalar_subquery())
+    following_total = (db.select(db.func.count()).select_from(followers_association)
+                       .where(followers_association.c.follower_id == User.id).scalar_subquery())
+
+    fixes = [
+        ('post likes', Post, Post.likes_count, like_total),
+        ('post comments', Post, Post.comments_count, comment_total),
+        ('user followers', User, User.followers_count, follower_total),
+        ('user following', User, User.following_count, following_total),
+    ]
+    for label, model, column, total in fixes:
+        result = db.session.execute(
+            db.update(model).where(column != total).values({column: total}),
+            execution_options={'synchronize_session': False})
+        print(f'{label}: repaired {result.rowcount} row(s)')
+    db.session.commit()
+
+@app.cli.command('rebuild-feeds')
+def rebuild_feeds():
+    """Rebuild every user's materialized home timeline from follows and group memberships."""
+    for user in User.query.yield_per(500):
+        db.session.execute(feed_entries.delete().where(feed_entries.c.user_id == user.id))
+        backfill_feed(user, author=user)
+        for followed in user.following:
+            backfill_feed(user, author=followed)
+        for group in user.groups:
+            backfill_feed(user, group=group)
+        db.session.commit()
+        print(f'{user.username}: rebuilt')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Re-index every user, group and post for search."""
+    search_backend.rebuild()
+    db.session.commit()
+    print('Search index rebuilt')
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations():
+    """Recompute every user's suggested people and groups."""
+    if sparse is not None:
+        scored = sparse_recommendations()
+    else:
+        print('NumPy/SciPy not installed; scoring one user at a time')
+        scored = ((user_id, *user_recommendations(user_id))
+                  for user_id in db.session.scalars(db.select(User.id)).all())
+    count = 0
+    for user_id, people, groups in scored:
+        store_recommendations(user_id, people, groups)
+        count += 1
+        if count % app.config['RECOMMENDATION_BATCH_SIZE'] == 0:
+            db.session.commit()
+    db.session.commit()
+    print(f'Recommendations rebuilt for {count} users')
+
+@app.cli.command('refresh-rankings')
+def refresh_rankings():
+    """Recompute every post's hotness and every group's activity from the stored counters."""
+    activity = {}
+    last_id = 0
+    while True:
+        # Keyset batches, each committed, so memory and transaction size stay flat
+        posts = db.session.execute(db.select(Post.id, Post.group_id, Post.likes_count, Post.comments_count,
+                                             Post.timestamp)
+                                   .where(Post.id > last_id).order_by(Post.id)
+                                   .limit(app.config['BULK_CHUNK_SIZE'])).all()
+        if not posts:
+            break
+        scores = {post.id: post_hotness(post.likes_count, post.comments_count, post.timestamp) for post in posts}
+        db.session.execute(db.update(Post), [{'id': post_id, 'hotness': score} for post_id, score in scores.items()])
+        db.session.commit()
+        for post in posts:
+            if post.group_id is not None:
+                activity[post.group_id] = log2_add(activity.get(post.group_id), scores[post.id])
+        last_id = posts[-1].id
+    db.session.execute(db.update(Group).values(activity=None))
+    if activity:
+        db.session.execute(db.update(Group), [{'id': group_id, 'activity': score}
+                                              for group_id, score in activity.items()])
+    db.session.commit()
+    print(f'Rankings refreshed for {len(activity)} active groups')
+
+@app.cli.command('copy-to-replicas')
+def copy_to_replicas():
+    """Copy the primary SQLite database into each SQLite read replica (for local testing)."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Only SQLite databases can be copied; replicate server databases natively.')
+    for key in read_replicas.keys:
+        engine = db.engines[key]
+        if engine.dialect.name != 'sqlite':
+            print(f'{key}: skipped, not SQLite')
+            continue
+        source, target = db.engine.raw_connection(), engine.raw_connection()
+        try:
+            source.driver_connection.backup(target.driver_connection)
+        finally:
+            source.close()
+            target.close()
+        print(f'{key}: copied to {engine.url.database}')
+
+@app.cli.command('prune-uploads')
+def prune_uploads():
+    """Delete stored uploads (and their renditions) that nothing references any more."""
+    for stored in StoredFile.query.filter(StoredFile.ref_count <= 0).all():
+        key = stored.key
+        folder, _, stem = key.partition('/')
+        stem_path = os.path.join(app.config['UPLOAD_FOLDER'], folder, stem)
+        for path in glob.glob(glob.escape(stem_path) + '*'):
+            os.remove(path)
+        db.session.delete(stored)
+        db.session.commit()
+        print(f'{key}: removed')
+
+def bulk_file_options(mode):
+    # One --<kind> FILE option per bulk kind; '-' is stdin/stdout
+    def decorate(command):
+        for kind in reversed(BULK_KINDS):
+            command = click.option(f'--{kind}', type=click.File(mode, encoding='utf-8', lazy=True),
+                                   help=f'{kind.capitalize()} file (.ndjson or .csv)')(command)
+        return click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']),
+                            help='Record format; by default taken from each file extension')(command)
+    return decorate
+
+@app.cli.command('export-data')
+@bulk_file_options('w')
+def export_data(fmt, **files):
+    """Stream users, groups, follows, memberships, posts, comments and likes out to files.
+
+    Rows are fetched BULK_CHUNK_SIZE at a time, so memory stays flat whatever the size
+    of the database. Password hashes are included so accounts survive an import.
+    """
+    for kind in BULK_KINDS:
+        out = files[kind]
+        if out is None:
+            continue
+        fields, records = export_records(kind)
+        count = write_records(out, record_format(out, fmt), fields, records)
+        out.close()
+        click.echo(f'{kind}: exported {count} record(s)', err=True)
+
+@app.cli.command('import-data')
+@bulk_file_options('r')
+@click.option('--skip-rebuild', is_flag=True,
+              help='Leave counters, timelines, search index and suggestions for a later run')
+def import_data(fmt, skip_rebuild, **files):
+    """Stream records in from files, in chunked bulk inserts.
+
+    Kinds load in dependency order. Users and groups are referenced by username and
+    name; ones whose name (or email) is already taken are reported and refused, along
+    with every record that refers to them, rather than merged into the existing account.
+    Posts get new ids, and comments and likes are matched to the posts of the same run
+    by source id. Records whose references don't resolve are skipped. Users need a
+    password_hash or a plain password. Derived data is rebuilt once at the end instead
+    of row by row.
+    """
+    import_metadata.drop_all(db.engine)
+    import_metadata.create_all(db.engine)
+    try:
+        for kind in BULK_KINDS:
+            source = files[kind]
+            if source is None:
+                continue
+            read, inserted = import_records(kind, read_records(source, record_format(source, fmt)))
+            print(f'{kind}: {read} read, {read - inserted} skipped')
+    finally:
+        db.session.rollback()
+        import_metadata.drop_all(db.engine)
+
+    if not skip_rebuild:
+        context = click.get_current_context()
+        for command in (reconcile_counters, rebuild_feeds, rebuild_search_index, rebuild_recommendations,
+                        refresh_rankings):
+            context.invoke(command)
+
+SEED_WORDS = ('neuron protein genome climate quantum enzyme cortex plasma catalyst lattice '
+              'isotope receptor membrane spectra polymer vaccine microbe galaxy photon tensor '
+              'entropy ligand mutation fossil glacier aerosol neutrino peptide bacteria telescope').split()
+
+def zipf_weights(count, exponent):
+    # Rank-ordered weights: a few heavy items and a long tail
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+def skewed_sample(rng, population, weights, k):
+    # Up to k distinct items, drawn in proportion to weights
+    return set(rng.choices(population, weights=weights, k=k))
+
+@app.cli.command('seed-data')
+@click.option('--users', 'user_count', default=2000, show_default=True)
+@click.option('--groups', 'group_count', default=40, show_default=True)
+@click.option('--posts', 'post_count', default=20000, show_default=True)
+@click.option('--random-seed', default=1, show_default=True)
+def seed_data(user_count, group_count, post_count, random_seed):
+    """Add a large, skewed synthetic dataset for benchmarking.
+
+    Follower counts, group sizes, posting and likes follow power laws, so there are
+    celebrity accounts, a few huge groups and a handful of viral posts. Every seeded
+    account has the password 'password'.
+    """
+    rng = random.Random(random_seed)
+    prefix = f'seed{random_seed}'
+    now = datetime.utcnow()
+    def timestamp():
+        return now - timedelta(seconds=rng.randrange(90 * 24 * 3600))
+
+    password = password_hasher.hash('password')
+    db.session.execute(db.insert(User), [
+        {'username': f'{prefix}_{i}', 'email': f'{prefix}_{i}@example.com', 'password': password,
+         'bio': ' '.join(rng.choices(SEED_WORDS, k=6))}
+        for i in range(user_count)])
+    seeded_users = db.select(User.id).where(User.username.startswith(f'{prefix}_', autoescape=True))
+    user_ids = list(db.session.scalars(seeded_users.order_by(User.id)))
+    # Popularity ranks are shuffled so they don't follow id order
+    popular = rng.sample(user_ids, len(user_ids))
+    popularity = zipf_weights(len(popular), 1.1)
+
+    follows = []
+    for follower_id in user_ids:
+        wanted = min(int(rng.paretovariate(1.3) * 5), len(user_ids) - 1)
+        for followed_id in skewed_sample(rng, popular, popularity, wanted) - {follower_id}:
+            follows.append({'follower_id': follower_id, 'followed_id': followed_id, 'timestamp': timestamp()})
+    db.session.execute(insert_ignore(followers_association), follows)
+
+    db.session.execute(db.insert(Group), [
+        {'name': f'{prefix} group {i}', 'description': ' '.join(rng.choices(SEED_WORDS, k=8)),
+         'creator_id': rng.choice(user_ids), 'created_at': now - timedelta(days=90)}
+        for i in range(group_count)])
+    group_ids = list(db.session.scalars(db.select(Group.id).where(Group.name.like(f'{prefix} group %'))
+                                        .order_by(Group.id)))
+    # The largest group holds most users; the rest shrink by rank
+    members = {group_id: rng.sample(user_ids, max(2, int(len(user_ids) * 0.6 / (rank + 1))))
+               for rank, group_id in enumerate(group_ids)}
+    db.session.execute(insert_ignore(group_members), [
+        {'user_id': user_id, 'group_id': group_id, 'timestamp': timestamp()}
+        for group_id, user_list in members.items() for user_id in user_list])
+
+    authors = rng.choices(popular, weights=popularity, k=post_count)
+    group_weights = zipf_weights(len(group_ids), 1.0)
+    word_weights = zipf_weights(len(SEED_WORDS), 1.0)
+    posts = []
+    for author_id in authors:
+        post = {'user_id': author_id, 'timestamp': timestamp(),
+                'content': ' '.join(rng.choices(SEED_WORDS, weights=word_weights, k=rng.randint(8, 40)))}
+        if group_ids and rng.random() < 0.3:
+            group_id = rng.choices(group_ids, weights=group_weights)[0]
+            post.update(group_id=group_id, user_id=rng.choice(members[group_id]))
+        posts.append(post)
+    db.session.execute(db.insert(Post), posts)
+    posts = db.session.execute(db.select(Post.id, Post.user_id, Post.group_id, Post.timestamp)
+                               .where(Post.user_id.in_(seeded_users))).all()
+    post_ids = [post.id for post in posts]
+
+    # A few viral posts collect most of the likes and comments
+    virality = zipf_weights(len(post_ids), 1.2)
+    viral = rng.sample(post_ids, len(post_ids))
+    likes = {(rng.choice(user_ids), post_id)
+             for post_id in rng.choices(viral, weights=virality, k=post_count * 5)}
+    db.session.execute(insert_ignore(post_likes), [{'user_id': user_id, 'post_id': post_id}
+                                                   for user_id, post_id in likes])
+    comments = rng.choices(viral, weights=virality, k=post_count * 2)
+    db.session.execute(db.insert(Comment), [
+        {'user_id': rng.choice(user_ids), 'post_id': post_id, 'timestamp': timestamp(),
+         'content': ' '.join(rng.choices(SEED_WORDS, k=rng.randint(3, 15)))}
+        for post_id in comments])
+
+    # Counters and timelines are derived here from the generated rows; recomputing them
+    # with reconcile-counters and rebuild-feeds takes far longer at this size
+    followers = {user_id: [] for user_id in user_ids}
+    following_counts = dict.fromkeys(user_ids, 0)
+    for follow in follows:
+        followers[follow['followed_id']].append(follow['follower_id'])
+        following_counts[follow['follower_id']] += 1
+    db.session.execute(db.update(User), [
+        {'id': user_id, 'followers_count': len(followers[user_id]), 'following_count': following_counts[user_id]}
+        for user_id in user_ids])
+    like_counts = dict.fromkeys(post_ids, 0)
+    for _, post_id in likes:
+        like_counts[post_id] += 1
+    comment_counts = dict.fromkeys(post_ids, 0)
+    for post_id in comments:
+        comment_counts[post_id] += 1
+    db.session.execute(db.update(Post), [
+        {'id': post_id, 'likes_count': like_counts[post_id], 'comments_count': comment_counts[post_id]}
+        for post_id in post_ids])
+
+    # Same contents backfill_feed gives: the latest posts of each followed author and group
+    sources = {}
+    for post in posts:
+        sources.setdefault(('group', post.group_id) if post.group_id else ('author', post.user_id), []).append(post)
+    entries = {}
+    for (kind, source_id), source_posts in sources.items():
+        if kind == 'group':
+            readers = members[source_id]
+        elif len(followers[source_id]) > app.config['FEED_FANOUT_LIMIT']:
+            readers = [source_id]
+        else:
+            readers = followers[source_id] + [source_id]
+        source_posts.sort(key=lambda post: post.timestamp, reverse=True)
+        for post in source_posts[:app.config['FEED_BACKFILL_SIZE']]:
+            for reader_id in readers:
+                entries[(reader_id, post.id)] = post.timestamp
+    db.session.execute(insert_ignore(feed_entries), [
+        {'user_id': user_id, 'post_id': post_id, 'timestamp': timestamp}
+        for (user_id, post_id), timestamp in entries.items()])
+    db.session.commit()
+    print(f'Seeded {len(user_ids)} users, {len(follows)} follows, {len(group_ids)} groups, '
+          f'{len(post_ids)} posts, {len(likes)} likes, {len(comments)} comments, '
+          f'{len(entries)} timeline entries')
+
+    click.get_current_context().invoke(rebuild_search_index)
+    click.get_current_context().invoke(refresh_rankings)
+
+BENCHMARK_SEARCH_TERM = SEED_WORDS[0]
+
+def percentile(sorted_values, fraction):
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def benchmark_targets():
+    """Pick the heaviest profile, group and post, each with a viewer allowed to see it."""
+    celebrity = User.query.order_by(User.followers_count.desc()).first()
+    if celebrity is None:
+        raise click.ClickException('The database is empty; run `flask seed-data` first.')
+    fan = celebrity.followers.first() or celebrity
+    group = (Group.query.join(group_members).group_by(Group.id)
+             .order_by(db.func.count().desc()).first())
+    member = group.members.first() if group else fan
+    post = Post.query.order_by(Post.likes_count.desc()).first()
+    if post.group_id:
+        reader = post.group.members.first()
+    else:
+        reader = post.author.followers.first() or post.author
+
+    liked = [False]
+    def toggle_like():
+        liked[0] = not liked[0]
+        return 'POST', url_for('like_post' if liked[0] else 'unlike_post', post_id=post.id)
+
+    targets = {
+        'profile': (fan, lambda: ('GET', url_for('profile', username=celebrity.username))),
+        'feed': (fan, lambda: ('GET', url_for('feed'))),
+        'search': (fan, lambda: ('GET', url_for('search', search_query=BENCHMARK_SEARCH_TERM))),
+        'like_post': (reader, toggle_like),
+        'view_post': (reader, lambda: ('GET', url_for('view_post', post_id=post.id))),
+        'trending': (fan, lambda: ('GET', url_for('trending'))),
+    }
+    if group:
+        targets['view_group'] = (member, lambda: ('GET', url_for('view_group', group_id=group.id)))
+    return targets
+
+@app.cli.command('benchmark')
+@click.option('--requests', 'request_count', default=200, show_default=True, help='Timed requests per route.')
+@click.option('--warmup', default=20, show_default=True, help='Untimed requests per route first.')
+@click.option('--output', default='benchmark-results.json', show_default=True, type=click.Path())
+@click.option('--baseline', type=click.Path(exists=True), help='Earlier results to compare against.')
+def benchmark(request_count, warmup, output, baseline):
+    """Drive the main routes in-process; record throughput, latency and queries per request."""
+    queries = [0]
+    def count_query(*args):
+        queries[0] += 1
+
+    with app.test_request_context():
+        targets = benchmark_targets()
+        plans = {name: (viewer.id, [next_request() for _ in range(warmup + request_count)])
+                 for name, (viewer, next_request) in targets.items()}
+
+    results = {}
+    db.event.listen(db.engine, 'before_cursor_execute', count_query)
+    try:
+        for name, (viewer_id, requests) in plans.items():
+            client = app.test_client()
+            with client.session_transaction() as client_session:
+                client_session['_user_id'] = str(viewer_id)
+                client_session['_fresh'] = True
+            latencies, query_counts, errors = [], [], 0
+            for i, (method, url) in enumerate(requests):
+                queries[0] = 0
+                started = time.perf_counter()
+                # A fresh app context per request, or g and the session would outlive it
+                with app.app_context():
+                    response = client.open(url, method=method)
+                elapsed = time.perf_counter() - started
+                if i < warmup:
+                    continue
+                latencies.append(elapsed)
+                query_counts.append(queries[0])
+                errors += response.status_code >= 400
+            latencies.sort()
+            results[name] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput_rps': round(len(latencies) / sum(latencies), 1),
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+                'queries_mean': round(sum(query_counts) / len(query_counts), 2),
+                'queries_max': max(query_counts),
+            }
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count_query)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=app.root_path).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {
+        'commit': commit,
+        'created_at': datetime.utcnow().isoformat(),
+        'database': db.engine.dialect.name,
+        'dataset': {'users': db.session.scalar(db.select(db.func.count(User.id))),
+                    'groups': db.session.scalar(db.select(db.func.count(Group.id))),
+                    'posts': db.session.scalar(db.select(db.func.count(Post.id)))},
+        'routes': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)['routes']
+    print(f"{'route':<12}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}")
+    for name, result in results.items():
+        line = (f"{name:<12}{result['throughput_rps']:>9}{result['p50_ms']:>9}"
+                f"{result['p99_ms']:>9}{result['queries_mean']:>9}")
+        if name in previous:
+            change = (result['p50_ms'] - previous[name]['p50_ms']) / previous[name]['p50_ms'] * 100
+            line += f"   p50 {change:+.1f}%, queries {result['queries_mean'] - previous[name]['queries_mean']:+g}"
+        print(line)
+    print(f'Results written to {output}')
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
@@ -0,0 +1,54 @@
+"""denormalized counters
+
+Revision ID: 2fb01d00d5fd
+Revises: eb449383d85d
+Create Date: 2026-10-18 17:13:55.102311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2fb01d00d5fd'
+down_revision = 'eb449383d85d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('likes_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comments_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill as reconcile-counters does; follows are counted once per pair, as the
+    # association-table revision later deduplicates them
+    user = sa.table('user', sa.column('id'), sa.column('followers_count'), sa.column('following_count'))
+    post = sa.table('post', sa.column('id'), sa.column('likes_count'), sa.column('comments_count'))
+    follows = sa.table('followers_association', sa.column('follower_id'), sa.column('followed_id'))
+    post_likes = sa.table('post_likes', sa.column('post_id'))
+    comment = sa.table('comment', sa.column('post_id'))
+    op.execute(user.update().values(
+        followers_count=sa.select(sa.func.count(sa.distinct(follows.c.follower_id)))
+        .where(follows.c.followed_id == user.c.id).scalar_subquery(),
+        following_count=sa.select(sa.func.count(sa.distinct(follows.c.followed_id)))
+        .where(follows.c.follower_id == user.c.id).scalar_subquery()))
+    op.execute(post.update().values(
+        likes_count=sa.select(sa.func.count()).select_from(post_likes)
+        .where(post_likes.c.post_id == post.c.id).scalar_subquery(),
+        comments_count=sa.select(sa.func.count()).select_from(comment)
+        .where(comment.c.post_id == post.c.id).scalar_subquery()))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('comments_count')
+        batch_op.drop_column('likes_count')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('followers_count')
@@ -0,0 +1,40 @@
+"""search index
+
+Revision ID: 3ab438ccf13a
+Revises: 63073f1ffa23
+Create Date: 2026-10-18 17:14:02.871930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3ab438ccf13a'
+down_revision = '63073f1ffa23'
+branch_labels = None
+depends_on = None
+
+# kind -> (table, title column, body column), as in SearchBackend.fields
+SOURCES = {
+    'user': ('"user"', 'username', 'bio'),
+    'group': ('"group"', 'name', 'description'),
+    'post': ('post', "''", 'content'),
+}
+
+
+def upgrade():
+    # Search index tables (see FTS5SearchBackend); other databases use the 'like' backend
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for kind, (table, title, body) in SOURCES.items():
+        op.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS search_{kind} USING fts5('
+                   f"title, body, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        op.execute(f'INSERT INTO search_{kind} (rowid, title, body) '
+                   f"SELECT id, COALESCE({title}, ''), COALESCE({body}, '') FROM {table}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for kind in SOURCES:
+            op.execute(f'DROP TABLE IF EXISTS search_{kind}')
@@ -0,0 +1,71 @@
+"""keys and indexes for association tables
+
+Revision ID: 76689f681899
+Revises: fd80bb9b61dd
+Create Date: 2026-10-18 17:14:30.299562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '76689f681899'
+down_revision = 'fd80bb9b61dd'
+branch_labels = None
+depends_on = None
+
+# table -> (primary key columns, {index name: columns})
+TABLES = {
+    'followers_association': (['follower_id', 'followed_id'], {
+        'ix_followers_association_followed': ['followed_id', 'follower_id'],
+        'ix_followers_association_follower_timestamp': ['follower_id', 'timestamp'],
+        'ix_followers_association_followed_timestamp': ['followed_id', 'timestamp'],
+    }),
+    'follow_requests': (['requester_id', 'requested_id'], {
+        'ix_follow_requests_requested': ['requested_id', 'requester_id'],
+        'ix_follow_requests_requested_timestamp': ['requested_id', 'timestamp'],
+    }),
+    'group_members': (['user_id', 'group_id'], {
+        'ix_group_members_group': ['group_id', 'user_id'],
+        'ix_group_members_group_timestamp': ['group_id', 'timestamp'],
+    }),
+}
+
+
+def _deduplicate(table, key_columns):
+    # Keep the earliest row per key and drop rows with a missing key
+    keys = ', '.join(key_columns)
+    op.execute(f'CREATE TABLE _dedup_{table} AS SELECT {keys}, MIN(timestamp) AS timestamp '
+               f'FROM {table} WHERE {" AND ".join(f"{c} IS NOT NULL" for c in key_columns)} '
+               f'GROUP BY {keys}')
+    op.execute(f'DELETE FROM {table}')
+    op.execute(f'INSERT INTO {table} ({keys}, timestamp) SELECT {keys}, timestamp FROM _dedup_{table}')
+    op.execute(f'DROP TABLE _dedup_{table}')
+
+
+def upgrade():
+    for table, (key_columns, indexes) in TABLES.items():
+        _deduplicate(table, key_columns)
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in key_columns:
+                batch_op.alter_column(column, existing_type=sa.INTEGER(), nullable=False)
+            batch_op.create_primary_key(f'pk_{table}', key_columns)
+            for name, columns in indexes.items():
+                batch_op.create_index(name, columns, unique=False)
+
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.create_index('ix_post_likes_post', ['post_id', 'user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('post_likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_likes_post')
+
+    for table, (key_columns, indexes) in TABLES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name in indexes:
+                batch_op.drop_index(name)
+            batch_op.drop_constraint(f'pk_{table}', type_='primary')
+            for column in key_columns:
+                batch_op.alter_column(column, existing_type=sa.INTEGER(), nullable=True)
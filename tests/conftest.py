@@ -0,0 +1,43 @@
+import os
+
+# Never let the suite touch a configured database
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.pop('DATABASE_REPLICA_URLS', None)
+
+import pytest
+from sqlalchemy import event
+
+import app as synapse
+from app import db
+
+@pytest.fixture
+def app(monkeypatch):
+    """The app on an empty in-memory database, with fresh in-process caches."""
+    flask_app = synapse.app
+    monkeypatch.setitem(flask_app.config, 'TESTING', True)
+    monkeypatch.setitem(flask_app.config, 'BACKGROUND_TASKS_SYNC', True)
+    for name in ('user_cache', 'fragment_cache', 'ranking_cache'):
+        cache = getattr(synapse, name)
+        monkeypatch.setattr(synapse, name, synapse.LocalCache(1000, cache.ttl))
+    with flask_app.app_context():
+        db.create_all()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def statements(app):
+    """SQL statements sent to the database while the test runs."""
+    executed = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield executed
+    event.remove(engine, 'before_cursor_execute', record)
@@ -0,0 +1,49 @@
+"""Page query counts must not grow with the number of posts or comments shown."""
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as synapse
+from app import db, User, Group, Post, Comment
+
+PASSWORD = 'Passw0rd!'
+
+# Most statements each page may run for a signed-in follower, once load_user's cache is warm
+QUERY_CEILINGS = {
+    '/profile/u0': 6,
+    '/group/1': 6,
+    '/post/1': 4,  # personal post
+    '/post/2': 4,  # group post
+}
+
+def populate(app, posts):
+    # Five members of one group; u1 follows u0 and likes every post. The first two posts
+    # get `posts` comments from all five members, the rest one comment each
+    with app.app_context():
+        password = generate_password_hash(PASSWORD)
+        users = [User(username=f'u{i}', email=f'u{i}@example.com', password=password) for i in range(5)]
+        db.session.add_all(users)
+        group = Group(name='lab', description='d', creator=users[0])
+        group.members.extend(users)
+        users[1].following.append(users[0])
+        for i in range(posts):
+            post = Post(content=f'post {i}', author=users[i % 5], group=group if i % 2 else None)
+            for j in range(posts if i < 2 else 1):
+                post.comments.append(Comment(content=f'comment {j}', user=users[(i + j + 1) % 5]))
+            post.likes.append(users[1])
+            db.session.add(post)
+        db.session.commit()
+
+@pytest.mark.parametrize('posts', [4, 60])
+@pytest.mark.parametrize('url', list(QUERY_CEILINGS))
+def test_query_ceiling(app, client, statements, monkeypatch, url, posts):
+    populate(app, posts)
+    response = client.post('/signin', data={'username': 'u1', 'password': PASSWORD})
+    assert response.status_code == 302
+
+    # The first request also loads the signed-in user, which load_user then caches. Post
+    # cards are measured cold, so an N+1 inside post_card.html shows up
+    assert client.get(url).status_code == 200
+    monkeypatch.setattr(synapse, 'fragment_cache', synapse.LocalCache(1000, synapse.fragment_cache.ttl))
+    statements.clear()
+    assert client.get(url).status_code == 200
+    assert len(statements) <= QUERY_CEILINGS[url], '\n\n'.join(statements)